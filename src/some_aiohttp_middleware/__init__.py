@@ -1,6 +1,12 @@
 from .admin_auth import AdminAuth  # noqa: F401
-from .base import MiddlewareBase  # noqa: F401
 from .basic_auth import BasicAuth  # noqa: F401
 from .db import DB, Postgres  # noqa: F401
 from .dynamodb import DynamoDB, DynamoDBConfig  # noqa: F401
+from .logs import CorrelationId  # noqa: F401
 from .s3 import S3, S3Config  # noqa: F401
+
+from .base import (  # noqa: F401 # isort:skip
+    MiddlewareBase,
+    MiddlewareChain,
+    RouteDispatcher,
+)
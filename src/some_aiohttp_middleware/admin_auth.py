@@ -1,11 +1,12 @@
+import hmac
 import operator
 import re
 from functools import reduce
-from typing import Annotated, Any
+from typing import Annotated, Any, Optional
 
-from pydantic import AfterValidator, BaseModel, SecretStr, ValidationError
+from pydantic import AfterValidator, BaseModel, SecretStr
 
-from .base import MiddlewareBase
+from .base import HybridMethod, MiddlewareBase
 
 from aiohttp.web_exceptions import (  # isort:skip
     HTTPInternalServerError,
@@ -14,54 +15,111 @@ from aiohttp.web_exceptions import (  # isort:skip
 )
 
 
+BEARER = re.compile(r"Bearer\s([a-zA-Z\d]*)")
+
+
 def bearer_check(v: Any) -> Any:
     try:
-        return re.match(r"^Bearer\s([a-zA-Z\d]*)$", v).group(1)
+        return BEARER.fullmatch(v).group(1)
     except AttributeError:
         raise HTTPUnprocessableEntity(reason="Malformed bearer token")
 
 
+def parse_bearer(authorization: Optional[str]) -> bytes:
+    """
+    Fast path of the Bearer model: check the authorization header with the
+    precompiled pattern and return the token as bytes.
+    """
+    if authorization is None:
+        raise HTTPUnprocessableEntity(reason="Missing authorization header")
+    match = BEARER.fullmatch(authorization)
+    if match is None:
+        raise HTTPUnprocessableEntity(reason="Malformed bearer token")
+    return match.group(1).encode("utf-8")
+
+
 class Bearer(BaseModel):
     authorization: Annotated[str, AfterValidator(bearer_check)]
 
 
+def resolve_admin_token(config, token_location) -> bytes:
+    """
+    Walk the token location through the configuration and return the token as bytes.
+    """
+    admin_token = reduce(operator.getitem, token_location, dict(config))
+    if isinstance(admin_token, SecretStr):
+        admin_token = admin_token.get_secret_value()
+    return admin_token.encode("utf-8")
+
+
 class AdminAuth(MiddlewareBase):
 
-    @staticmethod
-    async def handle(request, *args, admin_token=None, token_location=None, **kwargs):
+    @HybridMethod
+    async def ctx(cls_or_self, app):
+        """
+        Cleanup context to resolve the admin token once at startup
+
+                app.cleanup_ctx.append(AdminAuth(token_location=["admin", "token"]).ctx)
+
+        The resolved token is cached per token location and only resolved again, when
+        the configuration object of the app is replaced.
+        """
+        app["admin_auth"] = {}
+
+        if not cls_or_self.kwargs.get("admin_token"):
+            try:
+                cls_or_self.cached_token(app, cls_or_self.kwargs.get("token_location"))
+            except (KeyError, TypeError, AttributeError):
+                # Reported on the first request
+                pass
 
+        yield
+
+        app["admin_auth"].clear()
+
+    @staticmethod
+    def cached_token(app, token_location) -> bytes:
         if token_location is None:
             token_location = ["admin_token"]
+        token_location = tuple(
+            token_location if isinstance(token_location, list) else [token_location]
+        )
 
-        try:
-            admin_token = admin_token or reduce(
-                operator.getitem,
-                (
-                    token_location
-                    if isinstance(token_location, list)
-                    else [token_location]
-                ),
-                dict(request.app.config),
-            )
-            admin_token = (
-                admin_token.get_secret_value()
-                if isinstance(admin_token, SecretStr)
-                else admin_token
+        config = getattr(app, "config")
+        cache = app.get("admin_auth")
+        if cache is None:
+            return resolve_admin_token(config, token_location)
+
+        cached = cache.get(token_location)
+        if cached is None or cached[0] is not config:
+            cached = cache[token_location] = (
+                config,
+                resolve_admin_token(config, token_location),
             )
+        return cached[1]
+
+    @staticmethod
+    async def handle(request, *args, admin_token=None, token_location=None, **kwargs):
+
+        try:
+            if admin_token:
+                admin_token = (
+                    admin_token.get_secret_value()
+                    if isinstance(admin_token, SecretStr)
+                    else admin_token
+                ).encode("utf-8")
+            else:
+                admin_token = AdminAuth.cached_token(request.app, token_location)
         except (KeyError, TypeError, AttributeError):
             raise HTTPInternalServerError(
                 reason="Missing configuration, either pass 'admin_token' or 'token_location'"
             )
 
-        try:
-            if (
-                Bearer(
-                    authorization=request.headers.getone("authorization", None)
-                ).authorization
-                != admin_token
-            ):
-                raise HTTPUnauthorized
-        except ValidationError:
-            raise HTTPUnprocessableEntity(reason="Missing authorization header")
+        if not hmac.compare_digest(
+            parse_bearer(request.headers.get("authorization")), admin_token
+        ):
+            raise HTTPUnauthorized
 
+        # E.g. for RateLimit(key="token")
+        request["token_verified"] = True
         return request
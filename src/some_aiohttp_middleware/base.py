@@ -1,14 +1,17 @@
 import asyncio
 import logging
+import time
 from abc import ABC, abstractmethod
+from bisect import bisect_left
 from functools import partial, wraps
+from typing import Optional
 
 from aiohttp import hdrs
 from aiohttp.web import Request, View
 from aiohttp.web_middlewares import middleware
 from aiohttp_pydantic import PydanticView
 
-log = logging.getLogger()
+log = logging.getLogger(__name__)
 
 
 class HybridMethod(object):
@@ -48,9 +51,123 @@ class HybridMethod(object):
         return hybrid
 
 
+class Histogram(object):
+    """
+    Latency histogram with fixed, log-linear buckets (HDR style): every power of two
+    from 1µs to ~69s is split into 4 buckets. Recording a value is a bisect and an
+    increment, independent of the number of recorded values.
+    """
+
+    # Upper bounds of the buckets in nanoseconds
+    BOUNDS = tuple(
+        (1 << exponent) + sub * (1 << (exponent - 2))
+        for exponent in range(10, 36)
+        for sub in range(1, 5)
+    )
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, ns: int):
+        self.counts[bisect_left(self.BOUNDS, ns)] += 1
+        self.count += 1
+        self.sum += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, q: float) -> int:
+        """
+        Upper bound (in nanoseconds) of the bucket containing the q-th percentile
+        """
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+def route_of(request: Request) -> str:
+    route = getattr(request.match_info, "route", None)
+    resource = getattr(route, "resource", None)
+    return resource.canonical if resource is not None else "unmatched"
+
+
+class Instrumentation(object):
+    """
+    Timing of handle, the downstream handler and unhandle of middlewares
+
+            MiddlewareBase.instrumentation = Instrumentation(server_timing=True)
+
+    The instrumentation is opt-in and picked up when the middleware is created (via
+    middleware(), decorate() or MiddlewareChain). It can be set on MiddlewareBase for
+    all middlewares, on a subclass or on a single middleware object.
+
+    The timings are recorded in histograms keyed by middleware, route and phase
+    ("handle", "handler" or "unhandle"). The handler phase covers everything between
+    handle and unhandle, including the middlewares further down. With server_timing
+    a Server-Timing header is added to the responses.
+    """
+
+    def __init__(self, server_timing: bool = False):
+        self.server_timing = server_timing
+        self.histograms: dict = {}
+
+    def histogram(self, middleware: str, route: str, phase: str) -> Histogram:
+        key = (middleware, route, phase)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def wrap(self, name: str, handle, unhandle):
+        # Handle timing and handler start of this middleware, stored in the request
+        key = object()
+
+        async def timed_handle(request, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return await handle(request=request, **kwargs)
+            finally:
+                end = time.perf_counter_ns()
+                self.histogram(name, route_of(request), "handle").record(end - start)
+                request[key] = (end - start, end)
+
+        async def timed_unhandle(request, response, **kwargs):
+            start = time.perf_counter_ns()
+            route = route_of(request)
+            handle_ns, handler_start = request.pop(key)
+            self.histogram(name, route, "handler").record(start - handler_start)
+            try:
+                return await unhandle(request=request, response=response, **kwargs)
+            finally:
+                end = time.perf_counter_ns()
+                self.histogram(name, route, "unhandle").record(end - start)
+                if (
+                    self.server_timing
+                    and response is not None
+                    and not response.prepared
+                ):
+                    response.headers.add(
+                        "Server-Timing",
+                        f"{name}-handle;dur={handle_ns / 1e6:.3f}, "
+                        f"{name}-handler;dur={(start - handler_start) / 1e6:.3f}, "
+                        f"{name}-unhandle;dur={(end - start) / 1e6:.3f}",
+                    )
+
+        return timed_handle, timed_unhandle
+
+
 class MiddlewareBase(ABC):
     args = ()
     kwargs = {}
+    instrumentation: Optional[Instrumentation] = None
 
     def __init__(self, /, *args, **kwargs):
         super().__init__()
@@ -75,77 +192,375 @@ class MiddlewareBase(ABC):
             # We add the kwargs via partial and return the decorator function
             return partial(cls_or_self.decorate, **kwargs)
 
+        if not isinstance(obj, type):
+            # The decorator was used on a handler function
+            return cls_or_self.decorate_handler(obj, **kwargs)
+
         # The decorator was used on a class
         assert issubclass(obj, (View, PydanticView))
 
-        class NewClass(obj):
-            def __init__(self, *i_args, **i_kwargs):
-                super().__init__(*i_args, *i_kwargs)
+        # The generated classes are cached per decorated class, keyed by the middleware
+        # and the kwargs, so decorating the same view twice the same way is free
+        try:
+            key = (cls_or_self, tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            key = None
+        cache = vars(obj).get("_decorated")
+        if cache is None:
+            cache = {}
+            setattr(obj, "_decorated", cache)
+        elif key in cache:
+            return cache[key]
+
+        handle, unhandle, kwargs = bind(cls_or_self, kwargs)
+
+        def wrap(method):
+            @wraps(method)
+            async def wrapper(self):
+                await handle(request=self.request, **kwargs)
+                try:
+                    response = await obj(self.request)
+                except Exception as e:
+                    log.debug(
+                        "%s while handling request. Unhandling %s",
+                        type(e).__name__,
+                        middleware_name(cls_or_self),
+                    )
+                    await unhandle(request=self.request, response=None, **kwargs)
+                    raise e
+                await unhandle(request=self.request, response=response, **kwargs)
+                return response
+
+            return wrapper
+
+        NewClass = type(
+            obj.__name__,
+            (obj,),
+            {"__module__": obj.__module__, "__qualname__": obj.__qualname__},
+        )
+
+        # The HTTP methods are wrapped once, after the class was created. Like this
+        # PydanticView does not inject the parameters into the wrappers a second time,
+        # and the attribute access on the view is not slowed down.
+        for name in hdrs.METH_ALL:
+            method = getattr(obj, name.lower(), None)
+            if method is not None and asyncio.iscoroutinefunction(method):
+                setattr(NewClass, name.lower(), wrap(method))
+
+        if key is not None:
+            cache[key] = NewClass
 
-            def __getattribute__(self, name):
-                # Get the original method
-                original_method = super().__getattribute__(name)
+        return NewClass
 
-                # Check if the attribute is one of the View method to be decorated
-                if (
-                    callable(original_method)
-                    and asyncio.iscoroutinefunction(original_method)
-                    and str(name).upper() in hdrs.METH_ALL
-                ):
+    @HybridMethod
+    def decorate_handler(cls_or_self, handler, **kwargs):
+        """
+        Wrap a handler function, used by decorate
 
-                    @wraps(obj)
-                    async def wrapper():
-
-                        await cls_or_self.handle(
-                            request=self.request, **(cls_or_self.kwargs | kwargs)
-                        )
-                        try:
-                            response = await obj(self.request)
-                        except Exception as e:
-                            log.debug(
-                                f"{type(e).__name__} while handling request. "
-                                f"Unhandling {type(cls_or_self).__name__}"
-                            )
-                            await cls_or_self.unhandle(
-                                request=self.request,
-                                response=None,
-                                **(cls_or_self.kwargs | kwargs),
-                            )
-                            raise e
-                        await cls_or_self.unhandle(
-                            request=self.request,
-                            response=response,
-                            **(cls_or_self.kwargs | kwargs),
-                        )
-                        return response
-
-                    return wrapper
-
-                else:
-                    return original_method
+                @DB.decorate(db_name="backend")
+                async def handler(request):
+                    ...
 
-        return NewClass
+        The handle/unhandle callables and the kwargs are bound once, the wrapper is
+        the only additional coroutine per request. Middlewares without unhandle are
+        not awaited after the handler.
+        """
+        assert asyncio.iscoroutinefunction(handler)
+        handle, unhandle, kwargs = bind(cls_or_self, kwargs)
+
+        if not overrides_unhandle(cls_or_self) and cls_or_self.instrumentation is None:
+
+            @wraps(handler)
+            async def handle_only(request):
+                await handle(request=request, **kwargs)
+                return await handler(request)
+
+            return handle_only
+
+        @wraps(handler)
+        async def wrapper(request):
+            await handle(request=request, **kwargs)
+            try:
+                response = await handler(request)
+            except Exception as e:
+                log.debug(
+                    "%s while handling request. Unhandling %s",
+                    type(e).__name__,
+                    middleware_name(cls_or_self),
+                )
+                await unhandle(request=request, response=None, **kwargs)
+                raise e
+            await unhandle(request=request, response=response, **kwargs)
+            return response
+
+        return wrapper
 
     @HybridMethod
     def middleware(cls_or_self, *_args, **kwargs):
+        handle, unhandle, kwargs = bind(cls_or_self, kwargs)
+
         @middleware
         @wraps(cls_or_self.middleware)
         async def mw(request, handler):
-            await cls_or_self.handle(request=request, **(cls_or_self.kwargs | kwargs))
+            await handle(request=request, **kwargs)
             try:
                 response = await handler(request)
 
             except Exception as e:
                 log.debug(
-                    f"{type(e).__name__} while handling request. Unhandling {type(cls_or_self).__name__}"
-                )
-                await cls_or_self.unhandle(
-                    request=request, response=None, **(cls_or_self.kwargs | kwargs)
+                    "%s while handling request. Unhandling %s",
+                    type(e).__name__,
+                    middleware_name(cls_or_self),
                 )
+                await unhandle(request=request, response=None, **kwargs)
                 raise e
-            await cls_or_self.unhandle(
-                request=request, response=response, **(cls_or_self.kwargs | kwargs)
+            await unhandle(request=request, response=response, **kwargs)
+            return response
+
+        return mw
+
+
+def overrides_unhandle(cls_or_self) -> bool:
+    """
+    Check if a middleware (class or object) brings its own unhandle, or if it uses
+    the no-op of MiddlewareBase.
+    """
+    cls = cls_or_self if isinstance(cls_or_self, type) else type(cls_or_self)
+    return cls.unhandle is not MiddlewareBase.unhandle
+
+
+def middleware_name(cls_or_self) -> str:
+    return (
+        cls_or_self if isinstance(cls_or_self, type) else type(cls_or_self)
+    ).__name__
+
+
+def bind(cls_or_self, kwargs=None):
+    """
+    Resolve the handle and unhandle callables of a middleware (class or object) and
+    merge its kwargs with the given ones. This is done once when the middleware is
+    created, not on every request.
+    """
+    handle, unhandle = cls_or_self.handle, cls_or_self.unhandle
+    if cls_or_self.instrumentation is not None:
+        handle, unhandle = cls_or_self.instrumentation.wrap(
+            middleware_name(cls_or_self), handle, unhandle
+        )
+    return handle, unhandle, cls_or_self.kwargs | (kwargs or {})
+
+
+def stage(m) -> tuple:
+    handle, unhandle, kwargs = bind(m)
+    # Instrumented middlewares need unhandle to time the handler
+    if not overrides_unhandle(m) and m.instrumentation is None:
+        unhandle = None
+    return handle, unhandle, kwargs
+
+
+async def handle_group(request, group: tuple, handled: list):
+    """
+    Run the handles of a group of middlewares concurrently. The unhandles of the
+    middlewares whose handle succeeded are appended to handled (in the order of the
+    group), also if others failed. The first exception of the group is raised.
+    """
+    tasks = [
+        asyncio.ensure_future(handle(request=request, **kwargs))
+        for handle, _, kwargs in group
+    ]
+    try:
+        await asyncio.wait(tasks)
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    error = None
+    for (_, unhandle, kwargs), task in zip(group, tasks):
+        if task.cancelled():
+            error = error or asyncio.CancelledError()
+        elif task.exception() is not None:
+            error = error or task.exception()
+        elif unhandle is not None:
+            handled.append((unhandle, kwargs))
+    if error is not None:
+        raise error
+
+
+async def unhandle_all(request, handled: list, response):
+    """
+    Run the unhandles in reverse order. Like stacked middlewares, the ones after a
+    failed unhandle still run, with response None, and the first exception is
+    raised at the end.
+    """
+    error = None
+    for unhandle, kwargs in reversed(handled):
+        try:
+            await unhandle(request=request, response=response, **kwargs)
+        except Exception as e:
+            error = error or e
+            response = None
+    if error is not None:
+        raise error
+
+
+class MiddlewareChain(object):
+    """
+    Compile several middlewares into a single aiohttp middleware.
+
+            app = web.Application(
+                middlewares=[MiddlewareChain(AdminAuth, DB(db_name="backend")).middleware()]
             )
+
+    The kwargs of each middleware are merged and the handle/unhandle callables are
+    resolved once on initialization. Middlewares which do not override unhandle (e.g.
+    AdminAuth or BasicAuth) are not awaited after the handler at all.
+
+    The behaviour is the same as stacking the middlewares one by one: handle is called
+    in the given order, unhandle in the reverse order, and only for the middlewares
+    whose handle succeeded. If an unhandle fails, the remaining ones still run.
+
+    Middlewares given as a list (or tuple) form a group, whose handles run
+    concurrently. The next middleware or group starts when all handles of the group
+    are done, so dependencies are expressed by the order:
+
+            MiddlewareChain(AdminAuth, [DB(db_name="backend"), DynamoDB, S3])
+
+    If handles of a group fail, the handles of the group which succeeded are
+    unhandled nevertheless, and the first exception of the group is raised. The
+    handles of a group run in their own tasks, so context variables they set (e.g. by
+    CorrelationId) are not visible to the handler.
+    """
+
+    def __init__(self, *middlewares):
+        groups = []
+        for m in middlewares:
+            if isinstance(m, (list, tuple)):
+                groups.append(tuple(stage(member) for member in m))
+            else:
+                groups.append((stage(m),))
+        self.groups = tuple(groups)
+        self.stages = tuple(s for group in groups for s in group)
+
+    def middleware(self):
+        groups = self.groups
+
+        @middleware
+        async def mw(request, handler):
+            handled: list = []
+            try:
+                for group in groups:
+                    if len(group) > 1:
+                        await handle_group(request, group, handled)
+                        continue
+                    handle, unhandle, kwargs = group[0]
+                    await handle(request=request, **kwargs)
+                    if unhandle is not None:
+                        handled.append((unhandle, kwargs))
+                response = await handler(request)
+
+            except Exception as e:
+                log.debug(
+                    "%s while handling request. Unhandling chain", type(e).__name__
+                )
+                try:
+                    await unhandle_all(request, handled, None)
+                except Exception:
+                    log.debug("Unhandling chain failed", exc_info=True)
+                raise e
+            await unhandle_all(request, handled, response)
             return response
 
         return mw
+
+
+class RouteDispatcher(object):
+    """
+    Run middlewares only on the routes they are added for
+
+            dispatcher = RouteDispatcher()
+            dispatcher.add(AdminAuth, prefix="/admin")
+            dispatcher.add(DB(db_name="backend"), prefix="/api", methods={"POST"})
+            dispatcher.add(S3, names={"upload"})
+            dispatcher.setup(app)
+
+    A middleware is added for the routes matching all of the given filters: the path
+    prefix, the route names and the HTTP methods. Without filters it runs for all
+    routes. Concurrent groups can be added as a list, like in MiddlewareChain.
+
+    The routes of the app are only known when its router is frozen, so the
+    middlewares of each route are compiled into a MiddlewareChain on startup. A
+    request only looks up the chain of its route and method. Routes without any
+    middleware (e.g. health checks or static files) call the handler directly.
+    """
+
+    def __init__(self):
+        self.entries: list = []
+        self.chains: Optional[dict] = None
+
+    def add(self, middleware, prefix=None, names=None, methods=None):
+        self.entries.append(
+            (
+                middleware,
+                prefix.rstrip("/") if prefix is not None else None,
+                set(names) if names is not None else None,
+                {m.upper() for m in methods} if methods is not None else None,
+            )
+        )
+        return self
+
+    @staticmethod
+    def matches(route, method: str, prefix, names, methods) -> bool:
+        if prefix is not None:
+            path = route.resource.canonical
+            if path != prefix and not path.startswith(prefix + "/"):
+                return False
+        if names is not None and route.name not in names:
+            return False
+        return methods is None or method in methods
+
+    def compile(self, routes) -> dict:
+        chains = {}
+        for route in routes:
+            for method in (
+                hdrs.METH_ALL if route.method == hdrs.METH_ANY else {route.method}
+            ):
+                selected = [
+                    m
+                    for m, prefix, names, methods in self.entries
+                    if self.matches(route, method, prefix, names, methods)
+                ]
+                if selected:
+                    chains[(route, method)] = MiddlewareChain(*selected).middleware()
+        return chains
+
+    @staticmethod
+    def routes(app):
+        for resource in app.router.resources():
+            # The routes of sub applications are matched by the sub application
+            sub_app = getattr(resource, "_app", None)
+            if sub_app is not None:
+                yield from RouteDispatcher.routes(sub_app)
+            else:
+                yield from resource
+
+    async def on_startup(self, app):
+        self.chains = self.compile(self.routes(app))
+
+    def middleware(self):
+        @middleware
+        async def mw(request, handler):
+            if self.chains is None:
+                raise RuntimeError(
+                    "Use RouteDispatcher.setup(app) to compile the routes"
+                )
+            chain = self.chains.get((request.match_info.route, request.method))
+            if chain is None:
+                return await handler(request)
+            return await chain(request, handler)
+
+        return mw
+
+    def setup(self, app):
+        app.middlewares.append(self.middleware())
+        app.on_startup.append(self.on_startup)
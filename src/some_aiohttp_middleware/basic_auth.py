@@ -1,5 +1,12 @@
+import asyncio
+import hashlib
+import hmac
 import operator
-from base64 import urlsafe_b64decode
+import os
+import time
+from base64 import b64decode, b64encode, urlsafe_b64decode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 from typing import Any, Optional
 
@@ -15,6 +22,15 @@ from aiohttp.web_exceptions import (  # isort:skip
 )
 
 
+HASH_SCHEMES = ("pbkdf2_sha256", "scrypt")
+
+# The key derivations run in threads of their own, not in the default executor of
+# the loop, which also serves the DNS lookups (loop.getaddrinfo) of all clients.
+# Further checks queue up, so wrong passwords cost at most KDF_THREADS cores.
+KDF_THREADS = 2
+kdf_executor = ThreadPoolExecutor(max_workers=KDF_THREADS, thread_name_prefix="kdf")
+
+
 class BasicAuthModel(BaseModel):
     user: str
     password: str
@@ -41,11 +57,136 @@ class BasicAuthModel(BaseModel):
         return output
 
 
+def hash_password(
+    password: str,
+    scheme: str = "pbkdf2_sha256",
+    salt: Optional[bytes] = None,
+    iterations: int = 600_000,
+    n: int = 2**14,
+    r: int = 8,
+    p: int = 1,
+) -> str:
+    """
+    Hash a password for the users of BasicAuth, either with PBKDF2 or scrypt.
+
+            pbkdf2_sha256$<iterations>$<salt>$<hash>
+            scrypt$<n>$<r>$<p>$<salt>$<hash>
+    """
+    salt = salt or os.urandom(16)
+    if scheme == "pbkdf2_sha256":
+        params = [str(iterations)]
+        digest = hashlib.pbkdf2_hmac(
+            "sha256", password.encode("utf-8"), salt, iterations
+        )
+    elif scheme == "scrypt":
+        params = [str(n), str(r), str(p)]
+        digest = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p)
+    else:
+        raise ValueError(f"Unknown password hashing scheme '{scheme}'")
+    return "$".join(
+        [scheme, *params, b64encode(salt).decode(), b64encode(digest).decode()]
+    )
+
+
+def verify_password(stored: str, password: str) -> bool:
+    """
+    Verify a password against the value stored for the user. Values which are not
+    hashed with hash_password are compared as plaintext.
+    """
+    scheme, _, rest = stored.partition("$")
+    try:
+        if scheme == "pbkdf2_sha256":
+            iterations, salt, digest = rest.split("$")
+            derived = hashlib.pbkdf2_hmac(
+                "sha256", password.encode("utf-8"), b64decode(salt), int(iterations)
+            )
+        elif scheme == "scrypt":
+            n, r, p, salt, digest = rest.split("$")
+            derived = hashlib.scrypt(
+                password.encode("utf-8"),
+                salt=b64decode(salt),
+                n=int(n),
+                r=int(r),
+                p=int(p),
+            )
+        else:
+            return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+    except ValueError:
+        raise HTTPInternalServerError(reason="Malformed password hash")
+    return hmac.compare_digest(derived, b64decode(digest))
+
+
+async def check_password(stored: str, password: str) -> bool:
+    """
+    verify_password without blocking the event loop: the key derivation of hashed
+    values runs in kdf_executor (KDF_THREADS threads), so clients sending wrong
+    passwords neither stall the other requests nor the default executor. Plaintext
+    values are compared inline.
+    """
+    if stored.partition("$")[0] not in HASH_SCHEMES:
+        return verify_password(stored, password)
+    return await asyncio.get_running_loop().run_in_executor(
+        kdf_executor, verify_password, stored, password
+    )
+
+
+class VerificationCache(object):
+    """
+    Bounded LRU cache of successful BasicAuth verifications, so repeating clients do
+    not pay for the key derivation on every request.
+
+            cache = VerificationCache(maxsize=1024, ttl=300)
+            BasicAuth(cache=cache).middleware()
+
+    Entries are keyed by a digest of the authorization header and expire after ttl
+    seconds. An entry is also dropped if the stored password of the user changed.
+    Call invalidate after changing the user table to drop entries right away.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def key(authorization: str) -> bytes:
+        return hashlib.sha256(authorization.encode("utf-8")).digest()
+
+    def get(self, key: bytes, users: dict) -> bool:
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        user, stored, expires = entry
+        if expires < time.monotonic() or users.get(user) != stored:
+            del self.entries[key]
+            return False
+        self.entries.move_to_end(key)
+        return True
+
+    def set(self, key: bytes, user: str, stored: str):
+        self.entries[key] = (user, stored, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user: Optional[str] = None):
+        if user is None:
+            self.entries.clear()
+            return
+        for key in [k for k, v in self.entries.items() if v[0] == user]:
+            del self.entries[key]
+
+
 class BasicAuth(MiddlewareBase):
 
     @staticmethod
     async def handle(
-        request, *args, users: Optional[dict] = None, users_location=None, **kwargs
+        request,
+        *args,
+        users: Optional[dict] = None,
+        users_location=None,
+        cache: Optional[VerificationCache] = None,
+        **kwargs,
     ):
 
         if users_location is None:
@@ -67,11 +208,15 @@ class BasicAuth(MiddlewareBase):
             )
 
         try:
-            auth = BasicAuthModel.model_validate(
-                request.headers.getone("authorization", None)
-            )
-            if auth.user not in users or users[auth.user] != auth.password:
-                raise HTTPUnauthorized
+            authorization = request.headers.getone("authorization", None)
+            auth = BasicAuthModel.model_validate(authorization)
+            key = cache.key(authorization) if cache is not None else None
+            if key is None or not cache.get(key, users):
+                stored = users.get(auth.user)
+                if stored is None or not await check_password(stored, auth.password):
+                    raise HTTPUnauthorized
+                if key is not None:
+                    cache.set(key, auth.user, stored)
             request.authorization = auth.model_dump()
         except ValidationError:
             raise HTTPUnprocessableEntity(reason="Missing authorization header")
@@ -4,7 +4,9 @@ import boto3
 from aiohttp.web import Request, StreamResponse
 from pydantic_settings import BaseSettings
 
-from some_aiohttp_middleware import MiddlewareBase
+from .base import MiddlewareBase
+
+log = logging.getLogger(__name__)
 
 
 class CognitoConfig(BaseSettings):
@@ -63,8 +65,8 @@ class Cognito(MiddlewareBase):
             pool_region=cognito_config.region,
         )
 
-        logging.debug(
-            f"Connected Cognito {cognito_config.pool} in {cognito_config.region}"
+        log.debug(
+            "Connected Cognito %s in %s", cognito_config.pool, cognito_config.region
         )
 
     @staticmethod
@@ -1,13 +1,25 @@
-import logging as log
+import asyncio
+import logging
 import sys
-from typing import Literal
+import time
+from functools import partial
+from typing import Literal, Optional
 
-from aiohttp.web import HTTPInternalServerError, Request, StreamResponse
+import asyncpg
 from pydantic_settings import BaseSettings
+from sqlalchemy import event, exc
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from .base import MiddlewareBase
+from .query_cache import CachedSession, QueryCache
 
+from aiohttp.web import (  # isort:skip
+    HTTPInternalServerError,
+    HTTPServiceUnavailable,
+    Request,
+    StreamResponse,
+)
 from pydantic import (  # isort:skip
     Field,
     IPvAnyAddress,
@@ -19,9 +31,9 @@ from pydantic import (  # isort:skip
 )
 
 
-log.getLogger().setLevel("INFO")
+log = logging.getLogger(__name__)
 
-default_kwargs = {"db_name": "default"}
+default_kwargs = {"db_name": "default", "lazy": False, "readonly": False, "raw": False}
 
 
 class DBConfig(BaseSettings):
@@ -34,16 +46,39 @@ class DBConfig(BaseSettings):
     pool_overflow: conint(ge=1, le=1000) = 10
     pool_size_max: conint(ge=1, le=1000) = 50
     pool_timeout: conint(ge=1, le=1000) = 120
+    pool_recycle: conint(ge=-1) = -1
+    pool_pre_ping: bool = True
+    # Read replicas as host or host:port, sharing the credentials of the primary
+    replicas: list[IPvAnyAddress | str] = []
+    replica_balancing: Literal["round_robin", "least_in_flight"] = "round_robin"
+    replica_retry: conint(ge=1) = 30
+    # Prepared statements cached per connection of the raw asyncpg pool
+    statement_cache_size: conint(ge=0) = 100
+    # Cache of the results of queries with the cache_ttl execution option
+    # In process only, see QueryCache
+    query_cache: Literal["off", "local"] = "off"
+    query_cache_size: conint(ge=1) = 1024
 
     class Config:
         env_prefix = "S_"
 
-    def create_dsn(self, obfuscated=True):
+    def create_dsn(self, obfuscated=True, host=None):
         pw = self.password if obfuscated else self.password.get_secret_value()
+        host = host or f"{self.host}:{self.port}"
         return PostgresDsn(
-            f"{self.scheme}://{self.username}:{pw}@{self.host}:{self.port}/{self.database}"
+            f"{self.scheme}://{self.username}:{pw}@{host}/{self.database}"
         )
 
+    @property
+    def replica_dsns(self) -> list[PostgresDsn]:
+        return [
+            self.create_dsn(
+                obfuscated=False,
+                host=str(replica) if ":" in str(replica) else f"{replica}:{self.port}",
+            )
+            for replica in self.replicas
+        ]
+
     @computed_field(repr=True)
     @property
     def dsn(self) -> PostgresDsn:
@@ -54,18 +89,222 @@ class DBConfig(BaseSettings):
         return self.create_dsn()
 
 
+class MeteredPool(AsyncAdaptedQueuePool):
+    """
+    Connection pool counting the checkouts, the time spent waiting for a connection
+    and the timeouts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.wait_time_max = 0.0
+        self.timeouts = 0
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            wait_time = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_time += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+    def metrics(self) -> dict:
+        return {
+            "size": self.size(),
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": self.overflow(),
+            "checkouts": self.checkouts,
+            "wait_time": self.wait_time,
+            "wait_time_max": self.wait_time_max,
+            "timeouts": self.timeouts,
+        }
+
+
+def pool_metrics(app) -> dict:
+    """
+    The metrics of the connection pools of all databases (and their read replicas)
+
+            {"default": {"checked_out": 3, "overflow": -7, ...}, "default/replica0": ...}
+    """
+    metrics = {}
+    for name, engine in app.get("db_engine", {}).items():
+        metrics[name] = engine.pool.metrics()
+        replicas = app.get("db_replicas", {}).get(name)
+        for index, replica in enumerate(replicas.engines if replicas else []):
+            metrics[f"{name}/replica{index}"] = replica.pool.metrics()
+    return metrics
+
+
+class LazySession(object):
+    """
+    Proxy of a session, which is only created when the handler uses it for the first
+    time. Routes which never touch the database save creating and closing the
+    session object. Note that an AsyncSession only checks out a pool connection on
+    its first statement anyway.
+
+    The proxy is not an AsyncSession instance, "async with" gives the session itself.
+    """
+
+    def __init__(self, session_maker, name):
+        self.session_maker = session_maker
+        self.name = name
+        self.session = None
+
+    def open(self):
+        if self.session is None:
+            log.debug("Opening session for %s", self.name)
+            self.session = self.session_maker()
+        return self.session
+
+    def __getattr__(self, item):
+        return getattr(self.open(), item)
+
+    # Special methods are looked up on the type, bypassing __getattr__
+    async def __aenter__(self):
+        return await self.open().__aenter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return await self.open().__aexit__(exc_type, exc_value, traceback)
+
+
+class Replicas(object):
+    """
+    The read replicas of a database, read-only sessions are balanced over them
+    either round robin or to the replica with the least sessions in flight.
+
+    A replica failing to connect is skipped for retry seconds. If no replica is
+    healthy, read-only sessions go to the primary.
+    """
+
+    def __init__(
+        self, engines, balancing="round_robin", retry=30, session_options=None
+    ):
+        self.engines = engines
+        self.session_makers = [
+            async_sessionmaker(engine, **(session_options or {})) for engine in engines
+        ]
+        self.balancing = balancing
+        self.retry = retry
+        self.in_flight = [0] * len(engines)
+        self.unhealthy_until = [0.0] * len(engines)
+        self.next = 0
+
+        for index, engine in enumerate(engines):
+            event.listen(engine.sync_engine, "do_connect", partial(self.connect, index))
+
+    def connect(self, index, dialect, conn_rec, cargs, cparams):
+        try:
+            connection = dialect.connect(*cargs, **cparams)
+        except Exception as e:
+            log.warning(
+                "Replica %d failed to connect (%s), skipping it for %ss",
+                index,
+                type(e).__name__,
+                self.retry,
+            )
+            self.unhealthy_until[index] = time.monotonic() + self.retry
+            raise
+        self.unhealthy_until[index] = 0.0
+        return connection
+
+    def choose(self) -> Optional[int]:
+        now = time.monotonic()
+        healthy = [i for i, until in enumerate(self.unhealthy_until) if until <= now]
+        if not healthy:
+            return None
+        if self.balancing == "least_in_flight":
+            return min(healthy, key=self.in_flight.__getitem__)
+        index = next(
+            (i for i in healthy if i >= self.next % len(self.engines)), healthy[0]
+        )
+        self.next = index + 1
+        return index
+
+    def acquire(self) -> Optional[int]:
+        index = self.choose()
+        if index is not None:
+            self.in_flight[index] += 1
+        return index
+
+    def release(self, index: int):
+        self.in_flight[index] -= 1
+
+
+def asyncpg_dsn(dsn) -> str:
+    """
+    The DSN without the SQLAlchemy driver, e.g. postgresql+asyncpg:// -> postgresql://
+    """
+    dsn = dsn.get_secret_value() if isinstance(dsn, SecretStr) else str(dsn)
+    scheme, _, rest = dsn.partition("://")
+    return f"{scheme.split('+')[0]}://{rest}"
+
+
 class DB(MiddlewareBase):
+    """
+    Open a session of the database db_name for every request
+
+            app.cleanup_ctx.append(Postgres(config, name="backend").ctx)
+
+            @DB.decorate(db_name="backend")
+            class View(web.View):
+                async def get(self):
+                    session = self.request["db_session"]["backend"]
+
+    With raw=True a connection of the asyncpg pool of Postgres(..., raw=True) is
+    borrowed instead and available as request["db_connection"][db_name], e.g. for
+    fetch, copy_records_to_table or prepared statements. It is released after the
+    handler. If no connection is available within pool_timeout seconds, the request
+    is answered with 503.
+    """
+
     @staticmethod
     async def handle(request: Request, *args, **kwargs) -> Request:
         kwargs = default_kwargs | kwargs
+        if kwargs["raw"]:
+            try:
+                pool = request.app["db_pool"][kwargs["db_name"]]
+            except KeyError:
+                raise HTTPInternalServerError(reason="DB pool not found")
+            timeout = request.app.get("db_pool_timeout", {}).get(kwargs["db_name"])
+            try:
+                connection = await pool.acquire(timeout=timeout)
+            except asyncio.TimeoutError:
+                log.warning(
+                    "No connection of %s within %ss", kwargs["db_name"], timeout
+                )
+                raise HTTPServiceUnavailable(reason="DB pool timeout")
+            request.setdefault("db_connection", {})[kwargs["db_name"]] = connection
+            return request
+
         try:
-            sm = request.app["db_session_maker"][kwargs["db_name"]]()
+            sm = request.app["db_session_maker"][kwargs["db_name"]]
         except KeyError:
             raise HTTPInternalServerError(reason="DB session not found")
         if request.get("db_session") is None:
             request["db_session"] = {}
-        log.debug(f"Opening session for {kwargs['db_name']}")
-        request["db_session"][kwargs["db_name"]] = await sm.__aenter__()
+
+        if kwargs["readonly"]:
+            replicas = request.app.get("db_replicas", {}).get(kwargs["db_name"])
+            index = replicas.acquire() if replicas else None
+            if index is not None:
+                sm = replicas.session_makers[index]
+                request.setdefault("db_replica", {})[kwargs["db_name"]] = index
+
+        if kwargs["lazy"]:
+            request["db_session"][kwargs["db_name"]] = LazySession(
+                sm, kwargs["db_name"]
+            )
+            return request
+        log.debug("Opening session for %s", kwargs["db_name"])
+        request["db_session"][kwargs["db_name"]] = await sm().__aenter__()
         return request
 
     @staticmethod
@@ -73,66 +312,172 @@ class DB(MiddlewareBase):
         request: Request, response: StreamResponse, *args, **kwargs
     ) -> StreamResponse:
         kwargs = default_kwargs | kwargs
-        session = request["db_session"][kwargs["db_name"]]
-        log.debug(f"Closing session for {kwargs['db_name']}")
+        if kwargs["raw"]:
+            connection = request["db_connection"].pop(kwargs["db_name"])
+            await request.app["db_pool"][kwargs["db_name"]].release(connection)
+            return response
+
+        index = request.get("db_replica", {}).pop(kwargs["db_name"], None)
+        if index is not None:
+            request.app["db_replicas"][kwargs["db_name"]].release(index)
+
+        session = request["db_session"].pop(kwargs["db_name"])
+        if isinstance(session, LazySession):
+            session = session.session
+            if session is None:
+                return response
+        log.debug("Closing session for %s", kwargs["db_name"])
         await session.__aexit__(*sys.exc_info())
-        del request["db_session"][kwargs["db_name"]]
         return response
 
 
 class CTX:
 
-    def __init__(self, config, name):
+    def __init__(self, config, name, raw="raw"):
         self.config = config
         self.name = name
+        self.raw = raw
 
     def __get__(self, obj, objtype=None):
         config = getattr(obj, self.config)
         name = getattr(obj, self.name)
+        raw = getattr(obj, self.raw, False)
 
-        async def func(app):
+        async def raw_func(app):
             pool_size_max = getattr(config, "pool_size_max", 20)
-            max_overflow = getattr(config, "max_overflow", 10)
-
-            engine = create_async_engine(
-                (
-                    config.dsn.get_secret_value()
-                    if isinstance(config.dsn, SecretStr)
-                    else str(config.dsn)
-                ),
-                pool_size=pool_size_max,
-                max_overflow=max_overflow,
-                pool_pre_ping=True,
+            pool_timeout = getattr(config, "pool_timeout", 30)
+
+            # asyncpg has no maximal connection age, pool_recycle does not apply.
+            # Idle connections are closed after asyncpg's default of 300 seconds.
+            pool = await asyncpg.create_pool(
+                asyncpg_dsn(config.dsn),
+                min_size=min(pool_size_max, 10),
+                max_size=pool_size_max,
+                statement_cache_size=getattr(config, "statement_cache_size", 100),
             )
-            async_session = async_sessionmaker(engine)
+
+            if not app.get("db_pool", None):
+                app["db_pool"] = {}
+
+            app["db_pool"].update({name: pool})
+            app.setdefault("db_pool_timeout", {})[name] = pool_timeout
+
+            log.info(
+                "Created asyncpg pool (max: %s/timeout: %s) and connected to %s. "
+                "Available as '%s'",
+                pool_size_max,
+                pool_timeout,
+                config.model_dump()["dsn"],
+                name,
+            )
+
+            yield
+
+            await pool.close()
+
+            log.info("Closed db pool")
+
+        async def func(app):
+            pool_size_max = getattr(config, "pool_size_max", 20)
+            pool_overflow = getattr(config, "pool_overflow", 10)
+            pool_timeout = getattr(config, "pool_timeout", 30)
+
+            def create_engine(dsn):
+                return create_async_engine(
+                    (
+                        dsn.get_secret_value()
+                        if isinstance(dsn, SecretStr)
+                        else str(dsn)
+                    ),
+                    poolclass=MeteredPool,
+                    pool_size=pool_size_max,
+                    max_overflow=pool_overflow,
+                    pool_timeout=pool_timeout,
+                    pool_recycle=getattr(config, "pool_recycle", -1),
+                    pool_pre_ping=getattr(config, "pool_pre_ping", True),
+                )
+
+            session_options = {}
+            query_cache = getattr(config, "query_cache", "off")
+            if query_cache not in ("off", "local"):
+                raise ValueError(
+                    f"Unknown query cache '{query_cache}', use 'off' or 'local'"
+                )
+            if query_cache == "local":
+                cache = QueryCache(
+                    max_entries=getattr(config, "query_cache_size", 1024)
+                )
+                session_options = {
+                    "sync_session_class": CachedSession,
+                    "info": {"query_cache": cache},
+                }
+                app.setdefault("db_query_cache", {})[name] = cache
+
+            engine = create_engine(config.dsn)
+            async_session = async_sessionmaker(engine, **session_options)
 
             if not app.get("db_session_maker", None):
                 app["db_session_maker"] = {}
 
             app["db_session_maker"].update({name: async_session})
 
+            if not app.get("db_engine", None):
+                app["db_engine"] = {}
+
+            app["db_engine"].update({name: engine})
+
             log.info(
-                f"Created postgres pool (max: {pool_size_max}/overflow: {max_overflow}) "
-                f"and connected to {config.model_dump()['dsn']}. Available as '{name}'"
+                "Created postgres pool (max: %s/overflow: %s/timeout: %s) "
+                "and connected to %s. Available as '%s'",
+                pool_size_max,
+                pool_overflow,
+                pool_timeout,
+                config.model_dump()["dsn"],
+                name,
+            )
+
+            replicas = Replicas(
+                [create_engine(dsn) for dsn in getattr(config, "replica_dsns", [])],
+                balancing=getattr(config, "replica_balancing", "round_robin"),
+                retry=getattr(config, "replica_retry", 30),
+                session_options=session_options,
             )
+            if replicas.engines:
+                if not app.get("db_replicas", None):
+                    app["db_replicas"] = {}
+
+                app["db_replicas"].update({name: replicas})
+
+                log.info(
+                    "Created %d read replica pools for '%s'",
+                    len(replicas.engines),
+                    name,
+                )
 
             yield
 
             await engine.dispose()
+            for replica in replicas.engines:
+                await replica.dispose()
 
             log.info("Closed db")
 
-        return func
+        return raw_func if raw else func
 
 
 class Postgres:
+    """
+    Cleanup context of a database: a SQLAlchemy engine with its session maker, or
+    with raw=True a plain asyncpg pool (see DB)
+    """
 
-    def __init__(self, config, name="default"):
+    def __init__(self, config, name="default", raw=False):
         try:
             getattr(config, "dsn")
         except AttributeError:
             raise RuntimeError("DSN or location of DSN in the configuration needed")
         self.config = config
         self.name = name
+        self.raw = raw
 
-    ctx = CTX("config", "name")
+    ctx = CTX("config", "name", "raw")
@@ -1,11 +1,22 @@
+import asyncio
+import json
 import logging
 import sys
+from contextlib import AsyncExitStack
+from functools import partial
+from typing import Optional
 
 from aiobotocore.session import get_session
 from aiohttp.web import Request, StreamResponse
 from pydantic_settings import BaseSettings
 
-from some_aiohttp_middleware import MiddlewareBase
+from .base import MiddlewareBase
+
+log = logging.getLogger(__name__)
+
+# The maximal number of keys of a BatchGetItem and of items of a BatchWriteItem
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
 
 
 class DynamoDBConfig(BaseSettings):
@@ -21,11 +32,55 @@ class DynamoDBConfig(BaseSettings):
     table: str
     name: str
     region: str = "us-east-1"
+    endpoint_url: Optional[str] = None
+    # Seconds to collect get_item/put_item calls for a batch, 0 for one loop iteration
+    batch_window: float = 0
+    batch_retries: int = 5
+    # The hash (and range) key attributes, otherwise looked up with DescribeTable
+    key_attributes: list[str] = []
+
+
+def identity(value: dict) -> str:
+    return json.dumps(value, sort_keys=True)
 
 
 class DynamoDBSession:
+    """
+    A table of the request. Used as async context manager it gives the aiobotocore
+    client:
+
+            async with request["dynamodb"]["default"] as client:
+                await client.query(TableName=..., ...)
+
+    get_item and put_item are batched: the calls made by concurrent coroutines
+    within batch_window seconds (or the same loop iteration) are sent as
+    BatchGetItem/BatchWriteItem of up to 100/25 items.
+
+            items = await asyncio.gather(
+                *(request["dynamodb"]["default"].get_item(Key=key) for key in keys)
+            )
 
-    def __init__(self, *args, table_name, table_region, **kwargs):
+    Unprocessed keys and items are retried with exponential backoff up to
+    batch_retries times. A BatchWriteItem must not contain the same key twice, so a
+    put of a key which is already queued waits for the queued put and is sent as a
+    plain PutItem after it: the last call wins. The key attributes are taken from
+    key_attributes or looked up once with DescribeTable.
+    """
+
+    def __init__(
+        self,
+        *args,
+        table_name,
+        table_region,
+        endpoint_url=None,
+        client=None,
+        batch_window=0.0,
+        batch_retries=5,
+        batch_backoff=0.05,
+        key_attributes=None,
+        key_schemas=None,
+        **kwargs,
+    ):
         self._table_name = table_name
         assert self.table_name, "No dynamodb table name provided via parameter or env"
 
@@ -34,8 +89,30 @@ class DynamoDBSession:
             self.table_region
         ), "No dynamodb table region provided via parameter or env"
 
+        self._endpoint_url = endpoint_url
+
+        # The client shared via DynamoDB.ctx, it is closed with the app
+        self.client = client
         self.session = None
 
+        self.batch_window = batch_window
+        self.batch_retries = batch_retries
+        self.batch_backoff = batch_backoff
+        # Key identity -> (key, future) and (item, future) waiting for the next batch
+        self.gets: dict = {}
+        self.puts: list = []
+        self.scheduled: Optional[asyncio.Handle] = None
+        self.flushes: set = set()
+        # Key identity -> future of the last put of the key not done yet
+        self.put_keys: dict = {}
+        self.key_attributes = key_attributes or None
+        # Lookups of the key attributes per table with DescribeTable, shared by
+        # requests
+        self.key_schemas = key_schemas if key_schemas is not None else {}
+        # Without a shared client the batches use a client of their own
+        self.batch_session = None
+        self.batch_client: Optional[asyncio.Future] = None
+
     @property
     def table_name(self):
         return self._table_name
@@ -44,41 +121,300 @@ class DynamoDBSession:
     def table_region(self):
         return self._table_region
 
+    def create_client(self):
+        return get_session().create_client(
+            "dynamodb", region_name=self.table_region, endpoint_url=self._endpoint_url
+        )
+
     async def __aenter__(self):
-        session = get_session()
-        self.session = session.create_client("dynamodb", region_name=self.table_region)
+        if self.client is not None:
+            return self.client
+        self.session = self.create_client()
         return await self.session.__aenter__()
 
     async def __aexit__(self, exc_type, exc_value, traceback):
         if self.session:
             await self.session.__aexit__(exc_type, exc_value, traceback)
+            self.session = None
 
+    async def get_item(self, Key: dict) -> dict:
+        """
+        The item of the key, as {"Item": item}, or {} if there is none
+        """
+        entry = self.gets.get(identity(Key))
+        if entry is None:
+            entry = self.gets[identity(Key)] = (
+                Key,
+                asyncio.get_running_loop().create_future(),
+            )
+            self.schedule(len(self.gets) >= BATCH_GET_SIZE)
+        return await asyncio.shield(entry[1])
 
-class DynamoDB(MiddlewareBase):
-    @staticmethod
-    async def handle(request: Request, *args, **kwargs) -> Request:
-        config = getattr(request.app, "config", {})
-        dynamodb_configs = config.dynamodb
-        if not dynamodb_configs:
-            raise RuntimeError("No DynamoDB configuration found")
+    async def put_item(self, Item: dict) -> dict:
+        names = await self.key_names()
+        key = identity({name: Item[name] for name in names})
+        previous = self.put_keys.get(key)
+        future = self.put_keys[key] = asyncio.get_running_loop().create_future()
+        future.add_done_callback(partial(self.put_done, key))
+        if previous is None:
+            self.puts.append((Item, future))
+            self.schedule(len(self.puts) >= BATCH_WRITE_SIZE)
+        else:
+            task = asyncio.ensure_future(self.put_after(previous, Item, future))
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+        return await asyncio.shield(future)
+
+    def put_done(self, key: str, future: asyncio.Future):
+        if self.put_keys.get(key) is future:
+            del self.put_keys[key]
+
+    async def put_after(self, previous: asyncio.Future, item: dict, future):
+        await asyncio.wait([previous])
+        try:
+            client = await self.open_batch_client()
+            await client.put_item(TableName=self.table_name, Item=item)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result({})
+
+    async def key_names(self) -> list:
+        if self.key_attributes:
+            return self.key_attributes
+        # One lookup per table, awaited by all puts starting meanwhile
+        lookup = self.key_schemas.get(self.table_name)
+        if lookup is None:
+            lookup = self.key_schemas[self.table_name] = asyncio.ensure_future(
+                self.describe_key()
+            )
+            lookup.add_done_callback(self.lookup_done)
+        return await asyncio.shield(lookup)
+
+    async def describe_key(self) -> list:
+        client = await self.open_batch_client()
+        response = await client.describe_table(TableName=self.table_name)
+        return [k["AttributeName"] for k in response["Table"]["KeySchema"]]
+
+    def lookup_done(self, lookup: asyncio.Future):
+        # A failed lookup is tried again by the next put
+        if not lookup.cancelled() and lookup.exception() is None:
+            return
+        if self.key_schemas.get(self.table_name) is lookup:
+            del self.key_schemas[self.table_name]
+
+    def schedule(self, full: bool):
+        if full:
+            self.flush()
+        elif self.scheduled is None:
+            loop = asyncio.get_running_loop()
+            if self.batch_window:
+                self.scheduled = loop.call_later(self.batch_window, self.flush)
+            else:
+                self.scheduled = loop.call_soon(self.flush)
+
+    def flush(self):
+        if self.scheduled is not None:
+            self.scheduled.cancel()
+            self.scheduled = None
+
+        gets, self.gets = list(self.gets.values()), {}
+        puts, self.puts = self.puts, []
+        for batch, entries in ((self.batch_get, gets), (self.batch_write, puts)):
+            if entries:
+                task = asyncio.ensure_future(batch(entries))
+                self.flushes.add(task)
+                task.add_done_callback(self.flushes.discard)
+
+    async def open_batch_client(self):
+        if self.client is not None:
+            return self.client
+        if self.batch_client is None:
+            self.batch_session = self.create_client()
+            self.batch_client = asyncio.ensure_future(self.batch_session.__aenter__())
+        return await self.batch_client
+
+    async def send(self, request, entries: list):
+        """
+        Send the batch of entries (value, future) with request until all values were
+        processed, and resolve the futures with the results
+        """
+        pending: dict = {}
+        for value, future in entries:
+            pending.setdefault(identity(value), (value, []))[1].append(future)
+        try:
+            client = await self.open_batch_client()
+            for attempt in range(self.batch_retries + 1):
+                if attempt:
+                    await asyncio.sleep(self.batch_backoff * 2 ** (attempt - 1))
+                results, unprocessed = await request(
+                    client, [value for value, _ in pending.values()]
+                )
+                for key in list(pending):
+                    if key not in unprocessed:
+                        for future in pending.pop(key)[1]:
+                            if not future.done():
+                                future.set_result(results.get(key, {}))
+                if not pending:
+                    return
+            raise RuntimeError(
+                f"{len(pending)} items of {self.table_name} unprocessed "
+                f"after {self.batch_retries} retries"
+            )
+        except Exception as e:
+            for _, futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
 
-        if not request.get("dynamodb"):
-            request["dynamodb"] = {}
+    async def batch_get(self, entries: list):
+        names = list(entries[0][0])
 
-        for name, config in dynamodb_configs.items():
-            request["dynamodb"][name] = DynamoDBSession(
-                table_name=config.table, table_region=config.region
+        async def request(client, keys):
+            response = await client.batch_get_item(
+                RequestItems={self.table_name: {"Keys": keys}}
             )
-            logging.debug(
-                f"Connected table {name} to {config.table} in {config.region}"
+            results = {
+                identity({n: item[n] for n in names}): {"Item": item}
+                for item in response.get("Responses", {}).get(self.table_name, [])
+            }
+            unprocessed = response.get("UnprocessedKeys", {}).get(self.table_name, {})
+            return results, {identity(key) for key in unprocessed.get("Keys", [])}
+
+        await self.send(request, entries)
+
+    async def batch_write(self, entries: list):
+        async def request(client, items):
+            response = await client.batch_write_item(
+                RequestItems={
+                    self.table_name: [{"PutRequest": {"Item": item}} for item in items]
+                }
             )
+            unprocessed = response.get("UnprocessedItems", {}).get(self.table_name, [])
+            return {}, {identity(r["PutRequest"]["Item"]) for r in unprocessed}
+
+        await self.send(request, entries)
+
+    async def close(self):
+        """
+        Wait for the batches sent and close the client of the batches
+        """
+        if self.gets or self.puts:
+            self.flush()
+        if self.flushes:
+            await asyncio.gather(*self.flushes, return_exceptions=True)
+        if self.batch_session is not None:
+            await self.batch_session.__aexit__(None, None, None)
+            self.batch_session = None
+            self.batch_client = None
+
+
+class DynamoDBTables(dict):
+    """
+    The tables of a request, request["dynamodb"][name]. The session of a table is
+    only created, when the handler accesses it. The sessions created are counted per
+    table in sessions.
+    """
+
+    def __init__(
+        self,
+        configs: dict,
+        clients: dict,
+        sessions: Optional[dict] = None,
+        key_schemas: Optional[dict] = None,
+    ):
+        super().__init__()
+        self.configs = configs
+        self.clients = clients
+        self.sessions = sessions if sessions is not None else {}
+        self.key_schemas = key_schemas if key_schemas is not None else {}
+
+    def __missing__(self, name):
+        config = self.configs[name]
+        self[name] = DynamoDBSession(
+            table_name=config.table,
+            table_region=config.region,
+            endpoint_url=config.endpoint_url,
+            client=self.clients.get((config.region, config.endpoint_url)),
+            batch_window=getattr(config, "batch_window", 0),
+            batch_retries=getattr(config, "batch_retries", 5),
+            key_attributes=getattr(config, "key_attributes", None),
+            key_schemas=self.key_schemas,
+        )
+        self.sessions[name] = self.sessions.get(name, 0) + 1
+        return self[name]
+
+    def __contains__(self, name):
+        return name in self.configs
+
+    def get(self, name, default=None):
+        return self[name] if name in self.configs else default
+
+
+def dynamodb_configs(app) -> dict:
+    config = getattr(app, "config", {})
+    dynamodb_configs = getattr(config, "dynamodb", None)
+    if not dynamodb_configs:
+        raise RuntimeError("No DynamoDB configuration found")
+    return dynamodb_configs
+
+
+class DynamoDB(MiddlewareBase):
+    @staticmethod
+    async def ctx(app):
+        """
+        Cleanup context to create one client per region and endpoint at startup
+
+                app.cleanup_ctx.append(DynamoDB.ctx)
+
+        The clients are shared by all requests and closed at shutdown.
+        """
+        configs = dynamodb_configs(app)
+        session = get_session()
+
+        async with AsyncExitStack() as stack:
+            clients = {}
+            for config in configs.values():
+                key = (config.region, config.endpoint_url)
+                if key not in clients:
+                    clients[key] = await stack.enter_async_context(
+                        session.create_client(
+                            "dynamodb",
+                            region_name=config.region,
+                            endpoint_url=config.endpoint_url,
+                        )
+                    )
+                    log.info("Created dynamodb client in %s", config.region)
+            app["dynamodb"] = {
+                "configs": configs,
+                "clients": clients,
+                "sessions": {},
+                "key_schemas": {},
+            }
+
+            yield
+
+        log.info("Closed dynamodb clients")
+
+    @staticmethod
+    async def handle(request: Request, *args, **kwargs) -> Request:
+        registry = request.app.get("dynamodb")
+        if registry is None:
+            registry = {"configs": dynamodb_configs(request.app), "clients": {}}
+
+        request["dynamodb"] = DynamoDBTables(
+            registry["configs"],
+            registry["clients"],
+            registry.get("sessions"),
+            registry.get("key_schemas"),
+        )
         return request
 
     @staticmethod
     async def unhandle(
         request: Request, response: StreamResponse, *args, **kwargs
     ) -> StreamResponse:
-        for k, v in request["dynamodb"].items():
+        for v in request["dynamodb"].values():
             await v.__aexit__(*sys.exc_info())
-            logging.debug(f"closed session to table in {k}")
+            await v.close()
         return response
@@ -0,0 +1,65 @@
+import logging
+import re
+import uuid
+from contextvars import ContextVar
+
+from aiohttp.web import Request, StreamResponse
+
+from .base import MiddlewareBase
+
+# The package only logs to its own loggers (some_aiohttp_middleware.*). Handlers,
+# levels and formats are left to the application.
+logging.getLogger(__package__).addHandler(logging.NullHandler())
+
+HEADER = "X-Request-ID"
+
+# Correlation ids passed in by clients are only taken over if they look sane
+VALID_ID = re.compile(r"[\w.:-]{1,128}")
+
+correlation_id: ContextVar[str] = ContextVar("correlation_id", default="-")
+
+
+class CorrelationIdFilter(logging.Filter):
+    """
+    Add the correlation id of the current request to the log records
+
+            handler.addFilter(CorrelationIdFilter())
+            handler.setFormatter(logging.Formatter("%(correlation_id)s %(message)s"))
+
+    Outside of a request the correlation id is "-".
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class CorrelationId(MiddlewareBase):
+    """
+    Take the correlation id of a request from the X-Request-ID header, or create a
+    new one, and make it available to the logs (see CorrelationIdFilter) and as
+    request["correlation_id"]. The id is returned in the X-Request-ID header of the
+    response.
+
+            app.middlewares.append(CorrelationId.middleware())
+
+    Every request is handled in its own task, so the id does not leak into other
+    requests.
+    """
+
+    @staticmethod
+    async def handle(request: Request, *args, **kwargs) -> Request:
+        value = request.headers.get(HEADER, "")
+        if not VALID_ID.fullmatch(value):
+            value = uuid.uuid4().hex
+        request["correlation_id"] = value
+        correlation_id.set(value)
+        return request
+
+    @staticmethod
+    async def unhandle(
+        request: Request, response: StreamResponse, *args, **kwargs
+    ) -> StreamResponse:
+        if response is not None and not response.prepared:
+            response.headers[HEADER] = request["correlation_id"]
+        return response
@@ -1,39 +1,222 @@
-import logging as log
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
 
 from aiohttp.web import Request, StreamResponse
 from aiomcache import Client
-from pydantic import IPvAnyAddress, conint
+from pydantic import IPvAnyAddress, confloat, conint, model_validator
 from pydantic_settings import BaseSettings
 
 from .base import MiddlewareBase
 
-log.getLogger().setLevel("INFO")
+log = logging.getLogger(__name__)
 
 
 class MemcachedConfig(BaseSettings):
     host: IPvAnyAddress | str = "localhost"
     port: conint(ge=1024, le=65535) = 11211
+    pool_size: conint(ge=1, le=1000) = 2
+    pool_minsize: conint(ge=1, le=1000) | None = None
+    local_max_entries: conint(ge=0) = 1024
+    local_max_bytes: conint(ge=1) | None = None
+    local_ttl: confloat(gt=0) = 5
 
     class Config:
         env_prefix = "S_"
 
+    @model_validator(mode="after")
+    def check_pool(self):
+        if self.pool_minsize is not None and self.pool_minsize > self.pool_size:
+            raise ValueError("pool_minsize must not exceed pool_size")
+        return self
+
+
+def memcached_config(app):
+    config = getattr(app, "config")
+
+    if not config:
+        raise RuntimeError("No app configuration found")
+
+    try:
+        return getattr(config, "memcached")
+    except AttributeError:
+        raise RuntimeError("Memcached definition needed in the configuration")
+
+
+class LocalCache(object):
+    """
+    Bounded in-process LRU cache with a time to live, sized in entries and
+    optionally in bytes.
+    """
+
+    def __init__(
+        self, max_entries: int = 1024, max_bytes: Optional[int] = None, ttl: float = 5
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[1] >= time.monotonic():
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            self.delete(key)
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, key: bytes, value: bytes, exptime: int = 0):
+        self.delete(key)
+        if not self.max_entries or (
+            self.max_bytes is not None and len(value) > self.max_bytes
+        ):
+            return
+        ttl = min(self.ttl, exptime) if exptime > 0 else self.ttl
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.size += len(value)
+        while len(self.entries) > self.max_entries or (
+            self.max_bytes is not None and self.size > self.max_bytes
+        ):
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.stats["evictions"] += 1
+
+    def delete(self, key: bytes):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class TieredCache(object):
+    """
+    Cache with an in-process LRU in front of the shared memcached client
+
+            value = await request["cache"].get(b"key")
+            values = await request["cache"].multi_get(b"key1", b"key2")
+
+    Reads are served from the local cache if possible. Keys missing locally are
+    fetched from memcached in one batch and kept locally for local_ttl seconds, so
+    changes made by other processes are visible after that time at the latest.
+    """
+
+    def __init__(self, client: Client, local: LocalCache):
+        self.client = client
+        self.local = local
+        self.stats = {
+            "local": local.stats,
+            "memcached": {"hits": 0, "misses": 0, "evictions": 0},
+        }
+
+    async def get(self, key: bytes, default: Optional[bytes] = None):
+        value = self.local.get(key)
+        if value is None:
+            value = await self.client.get(key)
+            if value is None:
+                self.stats["memcached"]["misses"] += 1
+                return default
+            self.stats["memcached"]["hits"] += 1
+            self.local.set(key, value)
+        return value
+
+    async def multi_get(self, *keys: bytes) -> tuple:
+        values = [self.local.get(key) for key in keys]
+        # aiomcache rejects duplicate keys
+        missing = list(
+            dict.fromkeys(key for key, value in zip(keys, values) if value is None)
+        )
+        if missing:
+            fetched = dict(zip(missing, await self.client.multi_get(*missing)))
+            for i, key in enumerate(keys):
+                if values[i] is None:
+                    values[i] = fetched[key]
+                    if values[i] is None:
+                        self.stats["memcached"]["misses"] += 1
+                    else:
+                        self.stats["memcached"]["hits"] += 1
+                        self.local.set(key, values[i])
+        return tuple(values)
+
+    async def set(self, key: bytes, value: bytes, exptime: int = 0) -> bool:
+        result = await self.client.set(key, value, exptime=exptime)
+        self.local.set(key, value, exptime)
+        return result
+
+    async def delete(self, key: bytes) -> bool:
+        self.local.delete(key)
+        return await self.client.delete(key)
+
+    async def refresh_stats(self) -> dict:
+        """
+        Read the evictions of the memcached tier from the server
+        """
+        stats = await self.client.stats()
+        self.stats["memcached"]["evictions"] = int(stats.get(b"evictions", 0))
+        return self.stats
+
 
 class Memcached(MiddlewareBase):
     @staticmethod
-    async def handle(request: Request, *args, **kwargs) -> Request:
-        config = getattr(request.app, "config")
+    async def ctx(app):
+        """
+        Cleanup context to share one pooled client per app
 
-        if not config:
-            raise RuntimeError("No app configuration found")
+                app.cleanup_ctx.append(Memcached.ctx)
 
-        try:
-            memcached_config = getattr(config, "memcached")
-        except AttributeError:
-            raise RuntimeError("Memcached definition needed in the configuration")
+        The middleware attaches the shared client to the request instead of creating
+        a new client (and connection) for every request, and the TieredCache on top of
+        it as request["cache"].
+        """
+        config = memcached_config(app)
 
-        request["memcached"] = Client(
-            getattr(memcached_config, "host"), getattr(memcached_config, "port")
+        app["memcached"] = Client(
+            str(config.host),
+            config.port,
+            pool_size=config.pool_size,
+            pool_minsize=config.pool_minsize,
         )
+        app["cache"] = TieredCache(
+            app["memcached"],
+            LocalCache(
+                max_entries=config.local_max_entries,
+                max_bytes=config.local_max_bytes,
+                ttl=config.local_ttl,
+            ),
+        )
+
+        log.info(
+            "Created memcached pool (max: %s) to %s:%s",
+            config.pool_size,
+            config.host,
+            config.port,
+        )
+
+        yield
+
+        app["cache"].local.clear()
+        await app["memcached"].close()
+
+        log.info("Closed memcached")
+
+    @staticmethod
+    async def handle(request: Request, *args, **kwargs) -> Request:
+        client = request.app.get("memcached")
+
+        if client is None:
+            config = memcached_config(request.app)
+            client = Client(str(config.host), config.port)
+        elif "cache" in request.app:
+            request["cache"] = request.app["cache"]
+        request["memcached"] = client
 
         return request
 
@@ -43,7 +226,8 @@ class Memcached(MiddlewareBase):
     ) -> StreamResponse:
 
         client = request.get("memcached")
-        if client:
+        # The shared client is closed with the app
+        if client and client is not request.app.get("memcached"):
             await client.close()
 
         return response
@@ -0,0 +1,240 @@
+import asyncio
+import sys
+
+from aiohttp import hdrs
+from aiohttp.web import HTTPException, Request, StreamResponse
+
+from .base import Histogram, Instrumentation
+from .db import pool_metrics
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# The buckets exported per histogram: every power of two (the last sub-bucket of it)
+EXPORTED_BUCKETS = range(3, len(Histogram.BOUNDS), 4)
+
+
+def is_error(e: BaseException) -> bool:
+    # Redirects or responses raised to skip the handler (e.g. by ResponseCache) are
+    # not errors
+    return not isinstance(e, HTTPException) or e.status >= 400
+
+
+class Metrics(Instrumentation):
+    """
+    Instrumentation, which additionally counts the requests in flight and the errors
+    per middleware, rendered in the Prometheus text format
+
+            metrics = MiddlewareBase.instrumentation = Metrics()
+            add_metrics_route(app, metrics)
+
+    Everything runs on the event loop, so the counters are plain dicts updated
+    without any locking.
+    """
+
+    def __init__(self):
+        super().__init__(server_timing=False)
+        self.in_flight: dict = {}
+        self.errors: dict = {}
+
+    def error(self, name: str, phase: str):
+        key = (name, phase)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def wrap(self, name: str, handle, unhandle):
+        timed_handle, timed_unhandle = super().wrap(name, handle, unhandle)
+        self.in_flight.setdefault(name, 0)
+        # Set in the request while it is counted in flight
+        key = object()
+
+        def leave(request):
+            if request.pop(key, False):
+                self.in_flight[name] -= 1
+
+        async def counted_handle(request, **kwargs):
+            try:
+                result = await timed_handle(request=request, **kwargs)
+            except BaseException as e:
+                if is_error(e):
+                    self.error(name, "handle")
+                raise
+            self.in_flight[name] += 1
+            request[key] = True
+            task = asyncio.current_task()
+            if task is not None:
+                # unhandle is skipped if the request is cancelled
+                task.add_done_callback(lambda _: leave(request))
+            return result
+
+        async def counted_unhandle(request, response, **kwargs):
+            leave(request)
+            if response is None:
+                # The handler (or a middleware further down) raised, unhandle runs
+                # while the exception is handled
+                e = sys.exc_info()[1]
+                if e is not None and is_error(e):
+                    self.error(name, "handler")
+            try:
+                return await timed_unhandle(
+                    request=request, response=response, **kwargs
+                )
+            except BaseException as e:
+                if is_error(e):
+                    self.error(name, "unhandle")
+                raise
+
+        return counted_handle, counted_unhandle
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(**kwargs) -> str:
+    return ",".join(f'{k}="{escape(v)}"' for k, v in kwargs.items())
+
+
+def family(name: str, kind: str, help: str, samples) -> str:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{{{labels(**s)}}} {v}" for s, v in samples)
+    return "\n".join(lines) + "\n"
+
+
+def render_histogram(name: str, metrics: Metrics):
+    yield (
+        f"# HELP {name} Time spent per middleware, route and phase\n"
+        f"# TYPE {name} histogram\n"
+    )
+    # Histograms created while the output is written are left for the next scrape
+    for (middleware, route, phase), histogram in list(metrics.histograms.items()):
+        label = labels(middleware=middleware, route=route, phase=phase)
+        lines = []
+        cumulative = 0
+        start = 0
+        for index in EXPORTED_BUCKETS:
+            cumulative += sum(histogram.counts[start : index + 1])  # noqa: E203
+            start = index + 1
+            le = Histogram.BOUNDS[index] / 1e9
+            lines.append(f'{name}_bucket{{{label},le="{le:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum{{{label}}} {histogram.sum / 1e9}")
+        lines.append(f"{name}_count{{{label}}} {histogram.count}")
+        yield "\n".join(lines) + "\n"
+
+
+def backend_families(app):
+    """
+    The stats of the backends set up via their cleanup contexts
+    """
+    pools = pool_metrics(app)
+    for name, key, kind, help in (
+        ("db_pool_size", "size", "gauge", "Connections kept in the pool"),
+        ("db_pool_checked_out", "checked_out", "gauge", "Connections in use"),
+        ("db_pool_overflow", "overflow", "gauge", "Connections beyond the pool size"),
+        ("db_pool_checkouts_total", "checkouts", "counter", "Connection checkouts"),
+        (
+            "db_pool_wait_seconds_total",
+            "wait_time",
+            "counter",
+            "Time spent waiting for a connection",
+        ),
+        ("db_pool_timeouts_total", "timeouts", "counter", "Checkout timeouts"),
+    ):
+        yield family(
+            name, kind, help, [({"db": db}, m[key]) for db, m in pools.items()]
+        )
+
+    # aiomcache has no public pool statistics, skipped if its internals change
+    pool = getattr(app.get("memcached"), "_pool", None)
+    in_use = getattr(pool, "_in_use", None)
+    if pool is not None and hasattr(pool, "size") and in_use is not None:
+        yield family(
+            "memcached_pool_size",
+            "gauge",
+            "Connections of the memcached pool",
+            [
+                ({"state": "open"}, pool.size()),
+                ({"state": "in_use"}, len(in_use)),
+            ],
+        )
+    cache = app.get("cache")
+    if cache is not None:
+        yield family(
+            "cache_requests_total",
+            "counter",
+            "Lookups of the tiered cache",
+            [
+                ({"tier": tier, "result": result}, count)
+                for tier, stats in cache.stats.items()
+                for result, count in stats.items()
+            ],
+        )
+
+    dynamodb = app.get("dynamodb")
+    if dynamodb is not None:
+        yield family(
+            "dynamodb_clients",
+            "gauge",
+            "Shared DynamoDB clients",
+            [({}, len(dynamodb["clients"]))],
+        )
+        yield family(
+            "dynamodb_sessions_total",
+            "counter",
+            "Table sessions used by requests",
+            [({"table": n}, c) for n, c in dynamodb.get("sessions", {}).items()],
+        )
+
+    s3 = app.get("s3")
+    if s3 is not None:
+        yield family(
+            "s3_resources",
+            "gauge",
+            "Shared S3 resources (one per region)",
+            [({}, len(s3["sessions"]))],
+        )
+        yield family(
+            "s3_buckets", "gauge", "Opened S3 buckets", [({}, len(s3["buckets"]))]
+        )
+
+
+def render(app, metrics: Metrics):
+    """
+    The metrics in the Prometheus text format, in chunks of one metric family (or one
+    histogram)
+    """
+    yield family(
+        "middleware_in_flight",
+        "gauge",
+        "Requests between handle and unhandle of a middleware",
+        [({"middleware": n}, c) for n, c in metrics.in_flight.items()],
+    )
+    yield family(
+        "middleware_errors_total",
+        "counter",
+        "Exceptions per middleware and phase",
+        [({"middleware": n, "phase": p}, c) for (n, p), c in metrics.errors.items()],
+    )
+    yield from render_histogram("middleware_duration_seconds", metrics)
+    yield from backend_families(app)
+
+
+async def metrics_handler(request: Request) -> StreamResponse:
+    response = StreamResponse(headers={hdrs.CONTENT_TYPE: CONTENT_TYPE})
+    await response.prepare(request)
+    for chunk in render(request.app, request.app["metrics"]):
+        await response.write(chunk.encode("utf-8"))
+        # Give other requests a chance between the chunks
+        await asyncio.sleep(0)
+    await response.write_eof()
+    return response
+
+
+def add_metrics_route(app, metrics: Metrics, path: str = "/metrics"):
+    """
+    Add a route serving the metrics and the backend stats of the app
+
+            metrics = MiddlewareBase.instrumentation = Metrics()
+            add_metrics_route(app, metrics)
+    """
+    app["metrics"] = metrics
+    return app.router.add_get(path, metrics_handler)
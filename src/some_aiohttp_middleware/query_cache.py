@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import pickle
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, loading
+from sqlalchemy.sql.util import find_tables
+
+from .memcached import LocalCache
+
+log = logging.getLogger(__name__)
+
+
+class QueryCache(object):
+    """
+    Cache of query results, for the sessions of Postgres(...).ctx with query_cache
+    set in the configuration. Queries opt in with a time to live:
+
+            result = await session.execute(
+                select(Country).where(Country.code == code).execution_options(cache_ttl=300)
+            )
+
+    The results are keyed by the compiled SQL and its parameters and stored in a
+    LocalCache. Every table has a version, which is part of the key. Flushes and
+    bulk inserts, updates or deletes through the sessions bump the versions of the
+    tables written, so cached results of the same app instance are not served after
+    a write. Other instances serve their cached results until the ttl passes.
+
+    The results are stored pickled, so they are deliberately only kept in the
+    process: unpickling data from a shared cache like memcached would let anyone
+    able to write to it run code in the app.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        # The ttl of the queries applies, the LocalCache only bounds it to one day
+        self.backend = LocalCache(max_entries=max_entries, ttl=24 * 3600)
+        self.versions: dict = {}
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def key(self, statement, compiled, parameters) -> bytes:
+        key = hashlib.blake2b(digest_size=16)
+        key.update(str(compiled).encode("utf-8"))
+        key.update(repr(sorted({**compiled.params, **parameters}.items())).encode())
+        for table in sorted(tables_of(statement)):
+            key.update(f"\n{table}:{self.versions.get(table, 0)}".encode("utf-8"))
+        return b"query_cache:" + key.hexdigest().encode("ascii")
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        return self.backend.get(key)
+
+    def set(self, key: bytes, value: bytes, ttl: int):
+        self.backend.set(key, value, exptime=ttl)
+
+    def invalidate(self, *tables: str):
+        for table in tables:
+            self.versions[table] = self.versions.get(table, 0) + 1
+        self.stats["invalidations"] += len(tables)
+
+
+def tables_of(statement) -> set:
+    return {
+        table.name
+        for table in find_tables(statement, include_joins=True, include_aliases=True)
+    }
+
+
+class CachedSession(Session):
+    """
+    The session class of the session makers with a QueryCache in their info
+    """
+
+
+@event.listens_for(CachedSession, "do_orm_execute")
+def execute(orm_context):
+    cache = orm_context.session.info.get("query_cache")
+    if cache is None:
+        return None
+
+    if orm_context.is_insert or orm_context.is_update or orm_context.is_delete:
+        cache.invalidate(*tables_of(orm_context.statement))
+        return None
+
+    ttl = orm_context.execution_options.get("cache_ttl")
+    if not ttl or not orm_context.is_select:
+        return None
+
+    statement = orm_context.statement
+    compiled = statement.compile(dialect=orm_context.session.get_bind().dialect)
+    key = cache.key(statement, compiled, orm_context.parameters or {})
+
+    entry = cache.get(key)
+    if entry is not None:
+        cache.stats["hits"] += 1
+        # Only ever written by this process, see QueryCache
+        frozen = pickle.loads(entry)
+    else:
+        cache.stats["misses"] += 1
+        frozen = orm_context.invoke_statement().freeze()
+        # Pickled, so the results can not be changed through the entities returned
+        cache.set(key, pickle.dumps(frozen), ttl)
+
+    # ORM entities are merged into the session, without loading them again
+    return loading.merge_frozen_result(
+        orm_context.session, statement, frozen, load=False
+    )()
+
+
+@event.listens_for(CachedSession, "after_flush")
+def after_flush(session, flush_context):
+    cache = session.info.get("query_cache")
+    if cache is None:
+        return
+
+    tables = set()
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        mapper = getattr(instance, "__mapper__", None)
+        if mapper is not None:
+            tables.update(table.name for table in mapper.tables)
+    cache.invalidate(*tables)
+    # Cached again before the commit, the results would miss the changes
+    session.info.setdefault("query_cache_tables", set()).update(tables)
+
+
+@event.listens_for(CachedSession, "after_commit")
+def after_commit(session):
+    tables = session.info.pop("query_cache_tables", None)
+    if tables:
+        session.info["query_cache"].invalidate(*tables)
@@ -0,0 +1,230 @@
+import hashlib
+import logging
+import math
+import time
+from typing import Optional
+
+from aiohttp import hdrs
+from aiohttp.web import Request
+from aiohttp.web_exceptions import HTTPTooManyRequests
+from aiomcache.exceptions import ClientException
+
+from .base import MiddlewareBase
+
+log = logging.getLogger(__name__)
+
+default_kwargs: dict = {"key": "ip", "distributed": False}
+
+
+class TokenBuckets(object):
+    """
+    Token buckets per key: every key may do burst requests at once, refilled with
+    rate requests per second.
+
+    A bucket is a (tokens, timestamp) tuple in a dict, so the state per request is a
+    dict lookup and an update. Buckets idle for long enough to be full again are
+    indistinguishable from missing ones and are swept every sweep_interval seconds.
+    """
+
+    def __init__(self, rate: float, burst: int, sweep_interval: float = 60):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.sweep_interval = sweep_interval
+        self.buckets: dict = {}
+        self.next_sweep = time.monotonic() + sweep_interval
+
+    def take(self, key, now: Optional[float] = None) -> float:
+        """
+        Take a token for the key. Returns 0 if the request is allowed, otherwise the
+        seconds until the next token is available.
+        """
+        if now is None:
+            now = time.monotonic()
+        if now >= self.next_sweep:
+            self.sweep(now)
+
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+        self.buckets[key] = (tokens, now)
+        return (1 - tokens) / self.rate
+
+    def sweep(self, now: float):
+        idle = now - self.burst / self.rate
+        for key in [k for k, (_, last) in self.buckets.items() if last <= idle]:
+            del self.buckets[key]
+        self.next_sweep = now + self.sweep_interval
+
+
+class SharedWindows(object):
+    """
+    Fixed window counters per key, shared by several processes via memcached.
+
+    The requests of a window are counted locally and added to the counter in
+    memcached with one incr per batch requests, so memcached is not hit on every
+    request. A key is limited once the shared count plus the local pending requests
+    exceed limit, so the limit may be exceeded by up to batch requests per process.
+    Only one flush per key runs at a time, the requests counted meanwhile are added
+    with the next one.
+    """
+
+    def __init__(self, limit: int, window: int = 1, batch: int = 10):
+        self.limit = limit
+        self.window = window
+        self.batch = batch
+        # key -> [window, shared count, pending count, flushing], of the current
+        # window only
+        self.windows: dict = {}
+        self.current: Optional[int] = None
+
+    @staticmethod
+    def memcached_key(key, window: int) -> bytes:
+        digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=16)
+        return f"rate_limit:{digest.hexdigest()}:{window}".encode("ascii")
+
+    @staticmethod
+    async def incr(client, mkey: bytes, count: int) -> Optional[int]:
+        try:
+            return await client.incr(mkey, count)
+        except ClientException:
+            # aiomcache raises on NOT_FOUND instead of returning None
+            return None
+
+    async def flush(self, client, key, state: list):
+        mkey = self.memcached_key(key, state[0])
+        # Hits during the round trips stay pending for the next flush
+        count = state[2]
+        state[3] = True
+        try:
+            value = await self.incr(client, mkey, count)
+            if value is None:
+                # The first increment of the window in any process
+                if await client.add(
+                    mkey, str(count).encode("ascii"), exptime=2 * self.window
+                ):
+                    value = count
+                else:
+                    value = await client.incr(mkey, count)
+            state[1] = value or state[1] + count
+            state[2] -= count
+        finally:
+            state[3] = False
+
+    async def hit(self, client, key, now: Optional[float] = None) -> float:
+        """
+        Count a request for the key. Returns 0 if the request is allowed, otherwise
+        the seconds until the next window.
+        """
+        if now is None:
+            now = time.time()
+        window = int(now // self.window)
+
+        if window != self.current:
+            # The counts of past windows are not needed anymore
+            self.windows.clear()
+            self.current = window
+        state = self.windows.get(key)
+        if state is None:
+            state = self.windows[key] = [window, 0, 0, False]
+
+        if state[1] + state[2] >= self.limit:
+            return (window + 1) * self.window - now
+        state[2] += 1
+        if state[2] >= self.batch and not state[3]:
+            await self.flush(client, key, state)
+        return 0
+
+
+def rate_limit_key(request: Request, key):
+    if callable(key):
+        return key(request)
+    if key == "user":
+        authorization = getattr(request, "authorization", None)
+        if isinstance(authorization, dict) and authorization.get("user"):
+            return "user", authorization["user"]
+    elif key == "token":
+        # Made up tokens would get a bucket each, only verified ones are used
+        token = request.headers.get(hdrs.AUTHORIZATION)
+        if token and request.get("token_verified"):
+            return "token", hashlib.sha256(token.encode("utf-8")).digest()
+    return "ip", request.remote
+
+
+class RateLimit(MiddlewareBase):
+    """
+    Limit the requests per client with token buckets
+
+            app.middlewares.append(RateLimit(rate=10, burst=20).middleware())
+
+    Every client may do burst requests at once and rate requests per second on
+    average, further requests are answered with 429 and a Retry-After header. The
+    client is identified by key:
+
+    - "ip": the remote address of the request (default)
+    - "user": the user authenticated by BasicAuth, which has to run before
+    - "token": the Authorization header verified by AdminAuth, which has to run
+      before
+    - a callable returning the key for a request
+
+    Requests without a user or verified token are limited by their ip. Add RateLimit before
+    the backend middlewares (e.g. DB), so rejected requests do not take connections.
+
+    With distributed=True the requests are additionally counted per window seconds
+    across all processes sharing the memcached of Memcached.ctx (or the Memcached
+    middleware), allowing limit requests per window. See SharedWindows.
+    """
+
+    def __init__(
+        self,
+        /,
+        *args,
+        rate: float = 10,
+        burst: int = 20,
+        sweep_interval: float = 60,
+        limit: Optional[int] = None,
+        window: int = 1,
+        batch: int = 10,
+        **kwargs,
+    ):
+        kwargs["limiter"] = TokenBuckets(rate, burst, sweep_interval)
+        if kwargs.get("distributed"):
+            kwargs["shared"] = SharedWindows(
+                limit if limit is not None else math.ceil(rate * window), window, batch
+            )
+        super().__init__(*args, **kwargs)
+
+    @staticmethod
+    async def handle(request: Request, *args, **kwargs) -> Request:
+        kwargs = default_kwargs | kwargs
+        limiter = kwargs.get("limiter")
+        if limiter is None:
+            raise RuntimeError(
+                "RateLimit has to be configured, e.g. RateLimit(rate=10)"
+            )
+
+        key = rate_limit_key(request, kwargs["key"])
+        wait = limiter.take(key)
+
+        shared = kwargs.get("shared")
+        if not wait and shared is not None:
+            client = request.get("memcached") or request.app.get("memcached")
+            if client is None:
+                raise RuntimeError(
+                    "RateLimit(distributed=True) needs the Memcached middleware or "
+                    "Memcached.ctx"
+                )
+            try:
+                wait = await shared.hit(client, key)
+            except (OSError, ClientException) as e:
+                # Without memcached only the local limit applies
+                log.warning("Shared rate limit not available: %s", e)
+
+        if wait:
+            raise HTTPTooManyRequests(
+                headers={hdrs.RETRY_AFTER: str(max(1, math.ceil(wait)))}
+            )
+        return request
@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+from aiohttp import hdrs
+from aiohttp.web import Request, Response, StreamResponse
+from aiohttp.web_exceptions import HTTPNotModified, HTTPOk
+from aiomcache.exceptions import ClientException
+
+from .base import MiddlewareBase
+
+log = logging.getLogger(__name__)
+
+default_kwargs = {"ttl": 60, "headers": (), "timeout": 10, "max_size": 1000 * 1024}
+
+CACHED_HEADERS = (
+    hdrs.CONTENT_TYPE,
+    hdrs.CONTENT_LANGUAGE,
+    hdrs.CACHE_CONTROL,
+    hdrs.ETAG,
+    hdrs.LAST_MODIFIED,
+    hdrs.VARY,
+)
+
+
+def cache_control(headers) -> dict:
+    """
+    Parse the Cache-Control header into a dict of directives
+    """
+    directives = {}
+    for directive in headers.get(hdrs.CACHE_CONTROL, "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"')
+    return directives
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(t.strip().removeprefix("W/") == etag for t in if_none_match.split(","))
+
+
+def vary(headers) -> set:
+    """
+    The lowercase header names of the Vary header
+    """
+    return {
+        name.strip().lower()
+        for name in headers.get(hdrs.VARY, "").split(",")
+        if name.strip()
+    }
+
+
+def cache_key(request: Request, headers) -> bytes:
+    key = hashlib.blake2b(digest_size=16)
+    for part in (request.method, request.path, request.query_string):
+        key.update(part.encode("utf-8"))
+        key.update(b"\n")
+    for header in headers:
+        key.update(request.headers.get(header, "").encode("utf-8"))
+        key.update(b"\n")
+    return b"response_cache:" + key.hexdigest().encode("ascii")
+
+
+def dump(response: Response) -> bytes:
+    meta = {
+        "status": response.status,
+        "headers": {
+            h: response.headers[h] for h in CACHED_HEADERS if h in response.headers
+        },
+    }
+    return json.dumps(meta).encode("utf-8") + b"\n" + response.body
+
+
+def load(entry: bytes):
+    meta, _, body = entry.partition(b"\n")
+    return json.loads(meta), body
+
+
+class ResponseCache(MiddlewareBase):
+    """
+    Cache GET and HEAD responses in memcached
+
+            app.cleanup_ctx.append(Memcached.ctx)
+            app.cleanup_ctx.append(ResponseCache.ctx)
+            app.middlewares.append(ResponseCache(ttl=30, headers=["Accept"]).middleware())
+
+    Responses are keyed on method, path, query and the given request headers. A
+    response is stored with the ttl, unless its Cache-Control sets max-age/s-maxage
+    or forbids storing it. Cached responses get an ETag, and a matching
+    If-None-Match is answered with 304.
+
+    Responses to requests with an Authorization header are only stored if they are
+    marked public or set s-maxage (RFC 9111 3.5). Responses whose Vary names a
+    header which is not part of the key are not stored either, so e.g.
+    Vary: Authorization needs headers=["Authorization"].
+
+    With ResponseCache.ctx concurrent misses for the same key are coalesced: only
+    the first request runs the handler, the others wait (up to timeout seconds) and
+    are served its response.
+    """
+
+    @staticmethod
+    async def ctx(app):
+        app["response_cache"] = {}
+
+        yield
+
+        for future in app["response_cache"].values():
+            if not future.done():
+                future.set_result(None)
+        app["response_cache"].clear()
+
+    @staticmethod
+    def client(request: Request):
+        client = request.get("memcached") or request.app.get("memcached")
+        if client is None:
+            raise RuntimeError(
+                "ResponseCache needs the Memcached middleware or Memcached.ctx"
+            )
+        return client
+
+    @staticmethod
+    def serve(request: Request, entry: bytes):
+        meta, body = load(entry)
+        etag = meta["headers"].get(hdrs.ETAG)
+        if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+        if etag and if_none_match and etag_matches(if_none_match, etag):
+            raise HTTPNotModified(
+                headers={
+                    h: v
+                    for h, v in meta["headers"].items()
+                    if h in (hdrs.ETAG, hdrs.CACHE_CONTROL)
+                }
+            )
+        # Raising the response skips the handler
+        response = HTTPOk()
+        response.body = body
+        response.headers.update(meta["headers"])
+        raise response
+
+    @staticmethod
+    def ttl(request: Request, response: StreamResponse, kwargs) -> int:
+        """
+        The time to live of the response in the cache, 0 if it must not be stored
+        """
+        if (
+            not isinstance(response, Response)
+            or response.status != 200
+            or not isinstance(response.body, bytes)
+            or len(response.body) > kwargs["max_size"]
+            or hdrs.SET_COOKIE in response.headers
+            or "no-store" in cache_control(request.headers)
+        ):
+            return 0
+        directives = cache_control(response.headers)
+        if {"no-store", "no-cache", "private"} & directives.keys():
+            return 0
+        if hdrs.AUTHORIZATION in request.headers and not (
+            {"public", "s-maxage"} & directives.keys()
+        ):
+            return 0
+        # The key only distinguishes the requests by the configured headers
+        if vary(response.headers) - {h.lower() for h in kwargs["headers"]}:
+            return 0
+        try:
+            return int(
+                directives.get("s-maxage") or directives.get("max-age") or kwargs["ttl"]
+            )
+        except ValueError:
+            return kwargs["ttl"]
+
+    @staticmethod
+    async def handle(request: Request, *args, **kwargs) -> Request:
+        if request.method not in (hdrs.METH_GET, hdrs.METH_HEAD):
+            return request
+
+        kwargs = default_kwargs | kwargs
+        directives = cache_control(request.headers)
+        if "no-store" in directives:
+            return request
+
+        client = ResponseCache.client(request)
+        key = cache_key(request, kwargs["headers"])
+
+        if "no-cache" not in directives and directives.get("max-age") != "0":
+            try:
+                entry = await client.get(key)
+            except (OSError, ClientException) as e:
+                log.warning("Response cache not available: %s", e)
+                return request
+            if entry is not None:
+                ResponseCache.serve(request, entry)
+
+        inflight = request.app.get("response_cache")
+        if inflight is None:
+            request["response_cache"] = (key, None)
+            return request
+
+        future = inflight.get(key)
+        if future is None:
+            future = inflight[key] = asyncio.get_running_loop().create_future()
+            request["response_cache"] = (key, future)
+            # unhandle is skipped if the request is cancelled, the waiting requests
+            # must not wait for the timeout then
+            task = asyncio.current_task()
+            if task is not None:
+                task.add_done_callback(
+                    lambda _: ResponseCache.release(inflight, key, future, None)
+                )
+            return request
+
+        try:
+            entry = await asyncio.wait_for(asyncio.shield(future), kwargs["timeout"])
+        except asyncio.TimeoutError:
+            # The leading request did not finish (e.g. it was cancelled)
+            if inflight.get(key) is future:
+                del inflight[key]
+            entry = None
+        if entry is not None:
+            ResponseCache.serve(request, entry)
+
+        request["response_cache"] = (key, None)
+        return request
+
+    @staticmethod
+    def release(inflight: dict, key: bytes, future: asyncio.Future, entry):
+        """
+        Wake up the requests waiting for the same key
+        """
+        if inflight.get(key) is future:
+            del inflight[key]
+        if not future.done():
+            future.set_result(entry)
+
+    @staticmethod
+    async def unhandle(
+        request: Request, response: StreamResponse, *args, **kwargs
+    ) -> StreamResponse:
+        state = request.get("response_cache")
+        if state is None:
+            return response
+
+        kwargs = default_kwargs | kwargs
+        key, future = state
+        entry = None
+        try:
+            ttl = ResponseCache.ttl(request, response, kwargs)
+            if ttl:
+                if hdrs.ETAG not in response.headers:
+                    digest = hashlib.blake2b(response.body, digest_size=16)
+                    response.headers[hdrs.ETAG] = f'"{digest.hexdigest()}"'
+                entry = dump(response)
+                try:
+                    await ResponseCache.client(request).set(key, entry, exptime=ttl)
+                except (OSError, ClientException) as e:
+                    log.warning("Response cache not available: %s", e)
+        finally:
+            if future is not None:
+                ResponseCache.release(request.app["response_cache"], key, future, entry)
+
+        return response
@@ -1,11 +1,24 @@
+import asyncio
 import logging
-import sys
+from contextlib import AsyncExitStack
 
 from aioboto3 import Session
+from aiohttp import hdrs
 from aiohttp.web import Request, StreamResponse
+from botocore.exceptions import ClientError
 from pydantic_settings import BaseSettings
 
-from some_aiohttp_middleware import MiddlewareBase
+from .base import MiddlewareBase
+
+from aiohttp.web_exceptions import (  # isort:skip
+    HTTPNotFound,
+    HTTPRequestRangeNotSatisfiable,
+)
+
+log = logging.getLogger(__name__)
+
+# The minimal size of all but the last part of a multipart upload
+MIN_PART_SIZE = 5 * 1024 * 1024
 
 
 class S3Config(BaseSettings):
@@ -25,9 +38,15 @@ class S3Config(BaseSettings):
 
 class S3(MiddlewareBase):
     @staticmethod
-    async def handle(request: Request, *args, **kwargs) -> Request:
-        app = request.app
-        config = getattr(request.app, "config")
+    async def ctx(app):
+        """
+        Cleanup context to open one resource per region and the buckets at startup
+
+                app.cleanup_ctx.append(S3.ctx)
+
+        The resources are shared by all requests and closed at shutdown.
+        """
+        config = getattr(app, "config")
 
         if not config:
             raise RuntimeError("No S3 configuration found")
@@ -37,38 +56,166 @@ class S3(MiddlewareBase):
         except AttributeError:
             raise RuntimeError("S3 bucket definition needed in the configuration")
 
-        for s3_config in s3_configs:
-            if not app.get("s3"):
-                s3 = (
-                    await Session()
-                    .resource("s3", region_name=s3_config.region)
-                    .__aenter__()
-                )
-                app["s3"] = {
-                    "sessions": {s3_config.region: s3},
-                    "buckets": {s3_config.name: await s3.Bucket(s3_config.bucket)},
-                }
-            else:
-                if s3_config.region in app["s3"]["sessions"]:
-                    s3 = app["s3"]["sessions"][s3_config.region]
-                else:
-                    s3 = (
-                        await Session()
-                        .resource("s3", region_name=s3_config.region)
-                        .__aenter__()
+        session = Session()
+
+        async with AsyncExitStack() as stack:
+            app["s3"] = {"sessions": {}, "buckets": {}}
+            for s3_config in s3_configs:
+                if s3_config.region not in app["s3"]["sessions"]:
+                    app["s3"]["sessions"][s3_config.region] = (
+                        await stack.enter_async_context(
+                            session.resource("s3", region_name=s3_config.region)
+                        )
                     )
-                    app["s3"]["sessions"][s3_config.region] = s3
+                s3 = app["s3"]["sessions"][s3_config.region]
                 app["s3"]["buckets"][s3_config.name] = await s3.Bucket(s3_config.bucket)
-            logging.debug(
-                f"Connected bucket {s3_config.name} to {s3_config.bucket} in {s3_config.region}"
-            )
-        return request
+                log.debug(
+                    "Connected bucket %s to %s in %s",
+                    s3_config.name,
+                    s3_config.bucket,
+                    s3_config.region,
+                )
+
+            yield
+
+        log.info("Closed s3")
 
     @staticmethod
-    async def unhandle(
-        request: Request, response: StreamResponse, *args, **kwargs
-    ) -> StreamResponse:
-        for k, v in request.app["s3"]["sessions"].items():
-            await v.__aexit__(*sys.exc_info())
-            logging.debug(f"closed session to buckets in {k}")
-        return response
+    async def handle(request: Request, *args, **kwargs) -> Request:
+        try:
+            request["s3"] = request.app["s3"]["buckets"]
+        except KeyError:
+            raise RuntimeError("S3 is not set up, add S3.ctx to the app's cleanup_ctx")
+        return request
+
+
+async def stream_object(
+    request: Request, bucket, key: str, chunk_size: int = 64 * 1024
+) -> StreamResponse:
+    """
+    Stream an object of a bucket to the client in chunks of chunk_size
+
+            @S3.decorate
+            class Download(View):
+                async def get(self):
+                    return await stream_object(self.request, self.request["s3"]["1"], "key")
+
+    A Range header of the request is passed on to S3 and answered with 206.
+    """
+    params = {"Bucket": bucket.name, "Key": key}
+    if hdrs.RANGE in request.headers:
+        try:
+            request.http_range
+        except ValueError:
+            raise HTTPRequestRangeNotSatisfiable
+        params["Range"] = request.headers[hdrs.RANGE]
+
+    try:
+        obj = await bucket.meta.client.get_object(**params)
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code == "InvalidRange":
+            raise HTTPRequestRangeNotSatisfiable
+        if code in ("NoSuchKey", "404"):
+            raise HTTPNotFound
+        raise
+
+    response = StreamResponse(status=206 if obj.get("ContentRange") else 200)
+    response.headers[hdrs.CONTENT_TYPE] = obj.get(
+        "ContentType", "application/octet-stream"
+    )
+    response.headers[hdrs.ACCEPT_RANGES] = "bytes"
+    if obj.get("ContentRange"):
+        response.headers[hdrs.CONTENT_RANGE] = obj["ContentRange"]
+    if obj.get("ETag"):
+        response.headers[hdrs.ETAG] = obj["ETag"]
+    response.content_length = obj["ContentLength"]
+
+    body = obj["Body"]
+    async with body:
+        await response.prepare(request)
+        while True:
+            chunk = await body.read(chunk_size)
+            if not chunk:
+                break
+            await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+async def read_part(content, size: int) -> bytes:
+    try:
+        return await content.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+
+async def upload_stream(
+    request: Request,
+    bucket,
+    key: str,
+    part_size: int = 8 * 1024 * 1024,
+    concurrency: int = 4,
+    **params,
+) -> dict:
+    """
+    Stream the body of the request into an object of a bucket
+
+            await upload_stream(self.request, self.request["s3"]["1"], "key")
+
+    Bodies up to part_size are uploaded with one put_object, larger ones as multipart
+    upload with up to concurrency parts uploaded at the same time. At most
+    concurrency parts are held in memory. Additional params (e.g. ContentType) are
+    passed on to S3.
+    """
+    if part_size < MIN_PART_SIZE:
+        raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes")
+
+    client = bucket.meta.client
+    data = await read_part(request.content, part_size)
+    if len(data) < part_size:
+        return await client.put_object(Bucket=bucket.name, Key=key, Body=data, **params)
+
+    upload = await client.create_multipart_upload(Bucket=bucket.name, Key=key, **params)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upload_part(number, data):
+        try:
+            result = await client.upload_part(
+                Bucket=bucket.name,
+                Key=key,
+                UploadId=upload["UploadId"],
+                PartNumber=number,
+                Body=data,
+            )
+            return {"ETag": result["ETag"], "PartNumber": number}
+        finally:
+            semaphore.release()
+
+    tasks: list = []
+    try:
+        await semaphore.acquire()
+        while data:
+            tasks.append(asyncio.ensure_future(upload_part(len(tasks) + 1, data)))
+            await semaphore.acquire()
+            for task in tasks:
+                if task.done() and task.exception():
+                    raise task.exception()
+            data = await read_part(request.content, part_size)
+        semaphore.release()
+
+        parts = await asyncio.gather(*tasks)
+        return await client.complete_multipart_upload(
+            Bucket=bucket.name,
+            Key=key,
+            UploadId=upload["UploadId"],
+            MultipartUpload={"Parts": parts},
+        )
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client.abort_multipart_upload(
+            Bucket=bucket.name, Key=key, UploadId=upload["UploadId"]
+        )
+        raise
@@ -1,3 +1,6 @@
+import asyncio
+import threading
+
 import pytest
 from aiohttp import BasicAuth
 from aiohttp.web import Application, Response
@@ -5,6 +8,7 @@ from aiohttp.web_exceptions import HTTPOk, HTTPUnauthorized
 from aiohttp_pydantic import PydanticView
 from pydantic_settings import BaseSettings
 
+from some_aiohttp_middleware import basic_auth
 from some_aiohttp_middleware.basic_auth import BasicAuth as BasicAuthMiddleware
 
 
@@ -79,3 +83,108 @@ async def test_unsuccessful_auth(aiohttp_server, aiohttp_client, aiohttp_app, ca
     assert resp.status == HTTPUnauthorized.status_code
     text = await resp.text()
     assert text == "401: Unauthorized"
+
+
+def test_hash_password():
+    for scheme in ["pbkdf2_sha256", "scrypt"]:
+        stored = basic_auth.hash_password(
+            "PASSWORD_1", scheme=scheme, iterations=1000, n=2**4
+        )
+        assert stored.startswith(f"{scheme}$")
+        assert basic_auth.verify_password(stored, "PASSWORD_1")
+        assert not basic_auth.verify_password(stored, "WRONG_PASSWORD_1")
+    assert basic_auth.verify_password("PASSWORD_1", "PASSWORD_1")
+    assert not basic_auth.verify_password("PASSWORD_1", "WRONG_PASSWORD_1")
+    with pytest.raises(ValueError):
+        basic_auth.hash_password("PASSWORD_1", scheme="md5")
+
+
+@pytest.mark.asyncio
+async def test_hashed_users_cache(aiohttp_client, monkeypatch):
+    users = {"USER_1": basic_auth.hash_password("PASSWORD_1", iterations=1000)}
+    cache = basic_auth.VerificationCache(maxsize=1)
+
+    verified = []
+    verify_password = basic_auth.verify_password
+
+    def verify(stored, password):
+        verified.append(password)
+        return verify_password(stored, password)
+
+    monkeypatch.setattr(basic_auth, "verify_password", verify)
+
+    @BasicAuthMiddleware(users=users, cache=cache).decorate
+    class View(PydanticView):
+        async def get(self):
+            return Response(text=self.request.authorization["user"])
+
+    app = Application()
+    app.router.add_view("/test", View)
+
+    ok = {"Authorization": BasicAuth(login="USER_1", password="PASSWORD_1").encode()}
+    wrong = {"Authorization": BasicAuth(login="USER_1", password="WRONG").encode()}
+
+    async with await aiohttp_client(app) as client:
+        for _ in range(3):
+            resp = await client.get("/test", headers=ok)
+            assert resp.status == HTTPOk.status_code
+            assert await resp.text() == "USER_1"
+        assert verified == ["PASSWORD_1"]
+
+        resp = await client.get("/test", headers=wrong)
+        assert resp.status == HTTPUnauthorized.status_code
+        assert verified == ["PASSWORD_1", "WRONG"]
+
+        # A changed password drops the cached verification
+        users["USER_1"] = basic_auth.hash_password("PASSWORD_2", iterations=1000)
+        resp = await client.get("/test", headers=ok)
+        assert resp.status == HTTPUnauthorized.status_code
+        assert len(cache.entries) == 0
+
+        users["USER_1"] = basic_auth.hash_password("PASSWORD_1", iterations=1000)
+        resp = await client.get("/test", headers=ok)
+        assert resp.status == HTTPOk.status_code
+        assert len(cache.entries) == 1
+        cache.invalidate("USER_1")
+        assert len(cache.entries) == 0
+
+
+@pytest.mark.asyncio
+async def test_hashed_password_off_loop():
+    stored = basic_auth.hash_password("PASSWORD_1", iterations=200_000)
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0.001)
+
+    ticker = asyncio.ensure_future(tick())
+    await asyncio.sleep(0)
+    try:
+        assert not await basic_auth.check_password(stored, "WRONG")
+        assert await basic_auth.check_password(stored, "PASSWORD_1")
+    finally:
+        ticker.cancel()
+    # The loop kept running while the key was derived
+    assert len(ticks) > 3
+    assert await basic_auth.check_password("PASSWORD_1", "PASSWORD_1")
+
+
+@pytest.mark.asyncio
+async def test_kdf_executor(monkeypatch):
+    stored = basic_auth.hash_password("PASSWORD_1", iterations=1000)
+    threads = set()
+    verify_password = basic_auth.verify_password
+
+    def verify(stored, password):
+        threads.add(threading.current_thread().name)
+        return verify_password(stored, password)
+
+    monkeypatch.setattr(basic_auth, "verify_password", verify)
+    await asyncio.gather(
+        *(basic_auth.check_password(stored, "WRONG") for _ in range(10))
+    )
+    # Not the default executor, and not more threads than configured
+    assert all(name.startswith("kdf") for name in threads)
+    assert len(threads) <= basic_auth.KDF_THREADS
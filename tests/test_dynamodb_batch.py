@@ -0,0 +1,215 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.web import View, json_response
+from pydantic import BaseModel
+
+from some_aiohttp_middleware import DynamoDB, DynamoDBConfig
+from some_aiohttp_middleware.dynamodb import DynamoDBSession
+
+
+class FakeClient:
+    def __init__(self, items=(), unprocessed=0):
+        self.items = {item["id"]["S"]: item for item in items}
+        # Leave the last keys/items of the first responses unprocessed
+        self.unprocessed = unprocessed
+        self.calls = []
+
+    async def batch_get_item(self, RequestItems):
+        ((table, request),) = RequestItems.items()
+        keys = request["Keys"]
+        self.calls.append(("get", len(keys)))
+        response = {"Responses": {table: []}}
+        if self.unprocessed:
+            self.unprocessed -= 1
+            response["UnprocessedKeys"] = {table: {"Keys": keys[-1:]}}
+            keys = keys[:-1]
+        for key in keys:
+            if key["id"]["S"] in self.items:
+                response["Responses"][table].append(self.items[key["id"]["S"]])
+        return response
+
+    async def describe_table(self, TableName):
+        self.calls.append(("describe", TableName))
+        await asyncio.sleep(0)
+        return {"Table": {"KeySchema": [{"AttributeName": "id", "KeyType": "HASH"}]}}
+
+    async def put_item(self, TableName, Item):
+        self.calls.append(("put", Item["value"]["S"]))
+        self.items[Item["id"]["S"]] = Item
+
+    async def batch_write_item(self, RequestItems):
+        ((table, requests),) = RequestItems.items()
+        keys = [r["PutRequest"]["Item"]["id"]["S"] for r in requests]
+        if len(set(keys)) < len(keys):
+            raise ValueError("Provided list of item keys contains duplicates")
+        self.calls.append(("write", len(requests)))
+        response = {}
+        if self.unprocessed:
+            self.unprocessed -= 1
+            response["UnprocessedItems"] = {table: requests[-1:]}
+            requests = requests[:-1]
+        for r in requests:
+            item = r["PutRequest"]["Item"]
+            self.items[item["id"]["S"]] = item
+        return response
+
+
+def item(id, value="x"):
+    return {"id": {"S": str(id)}, "value": {"S": value}}
+
+
+def key(id):
+    return {"id": {"S": str(id)}}
+
+
+def session(client, **kwargs):
+    kwargs.setdefault("key_attributes", ["id"])
+    return DynamoDBSession(
+        table_name="table", table_region="eu-west-1", client=client, **kwargs
+    )
+
+
+@pytest.mark.asyncio
+async def test_batch_get():
+    client = FakeClient([item(i) for i in range(150)])
+    table = session(client)
+
+    results = await asyncio.gather(*(table.get_item(Key=key(i)) for i in range(160)))
+    assert results == [{"Item": item(i)} for i in range(150)] + [{}] * 10
+    assert client.calls == [("get", 100), ("get", 60)]
+
+    # The same key is requested once per batch
+    client.calls.clear()
+    results = await asyncio.gather(*(table.get_item(Key=key(1)) for _ in range(3)))
+    assert results == [{"Item": item(1)}] * 3
+    assert client.calls == [("get", 1)]
+    await table.close()
+
+
+@pytest.mark.asyncio
+async def test_batch_write():
+    client = FakeClient()
+    table = session(client, batch_window=0.01)
+
+    async def put(i):
+        # Calls of different loop iterations within the window are batched
+        await asyncio.sleep(0)
+        return await table.put_item(Item=item(i))
+
+    assert await asyncio.gather(*(put(i) for i in range(30))) == [{}] * 30
+    assert client.calls == [("write", 25), ("write", 5)]
+    assert sorted(client.items, key=int) == [str(i) for i in range(30)]
+
+    # Puts not awaited by the handler are sent on close
+    task = asyncio.ensure_future(table.put_item(Item=item(30)))
+    await asyncio.sleep(0)
+    await table.close()
+    assert "30" in client.items
+    assert task.done()
+
+
+@pytest.mark.asyncio
+async def test_unprocessed():
+    client = FakeClient([item(i) for i in range(3)], unprocessed=2)
+    table = session(client, batch_backoff=0)
+
+    results = await asyncio.gather(*(table.get_item(Key=key(i)) for i in range(3)))
+    assert results == [{"Item": item(i)} for i in range(3)]
+    assert client.calls == [("get", 3), ("get", 1), ("get", 1)]
+
+    client.calls.clear()
+    client.unprocessed = 3
+    table.batch_retries = 2
+    with pytest.raises(RuntimeError):
+        await asyncio.gather(table.put_item(Item=item(4)), table.put_item(Item=item(5)))
+    assert client.calls == [("write", 2), ("write", 1), ("write", 1)]
+    assert "4" in client.items and "5" not in client.items
+
+
+@pytest.mark.asyncio
+async def test_same_key():
+    client = FakeClient()
+    key_schemas: dict = {}
+    table = session(client, key_attributes=None, key_schemas=key_schemas)
+
+    results = await asyncio.gather(
+        *(table.put_item(Item=item(i % 2, value)) for i, value in enumerate("abcd"))
+    )
+    assert results == [{}] * 4
+    # The later puts of a key follow the batch one by one, the last one wins
+    assert client.calls == [
+        ("describe", "table"),
+        ("write", 2),
+        ("put", "c"),
+        ("put", "d"),
+    ]
+    assert client.items == {"0": item(0, "c"), "1": item(1, "d")}
+    assert table.put_keys == {}
+    assert key_schemas["table"].result() == ["id"]
+
+    # The key schema is looked up once
+    client.calls.clear()
+    await session(client, key_attributes=None, key_schemas=key_schemas).put_item(
+        Item=item(2)
+    )
+    assert client.calls == [("write", 1)]
+
+
+@pytest.mark.asyncio
+async def test_key_lookup():
+    client = FakeClient()
+    key_schemas: dict = {}
+    tables = [
+        session(client, key_attributes=None, key_schemas=key_schemas) for _ in range(3)
+    ]
+
+    # Concurrent puts of several requests share one DescribeTable
+    await asyncio.gather(*(t.put_item(Item=item(i)) for i, t in enumerate(tables * 5)))
+    assert client.calls.count(("describe", "table")) == 1
+    assert len(client.items) == 15
+
+    async def fail(TableName):
+        raise OSError("Connection refused")
+
+    # A failed lookup is not cached
+    client.describe_table = fail
+    key_schemas.clear()
+    with pytest.raises(OSError):
+        await tables[0].put_item(Item=item(0))
+    assert key_schemas == {}
+
+
+class Config(BaseModel):
+    dynamodb: dict[str, DynamoDBConfig] = {
+        "default": DynamoDBConfig(region="eu-west-1", table="table", batch_window=0.001)
+    }
+
+
+@pytest.mark.asyncio
+async def test_middleware(aiohttp_client):
+    fake = FakeClient([item(i) for i in range(5)])
+
+    @DynamoDB.decorate
+    class TestView(View):
+        async def get(self):
+            table = self.request["dynamodb"]["default"]
+            assert table.batch_window == 0.001
+            results = await asyncio.gather(
+                *(table.get_item(Key=key(i)) for i in range(10))
+            )
+            return json_response([bool(r) for r in results])
+
+    app = web.Application()
+    app.config = Config()
+    app["dynamodb"] = {
+        "configs": Config().dynamodb,
+        "clients": {("eu-west-1", None): fake},
+    }
+    app.router.add_view("/", TestView)
+
+    async with await aiohttp_client(app) as client:
+        resp = await client.get("/")
+        assert await resp.json() == [True] * 5 + [False] * 5
+    assert fake.calls == [("get", 10)]
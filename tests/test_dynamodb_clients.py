@@ -0,0 +1,54 @@
+import pytest
+from aiohttp import web
+from aiohttp.web import Response, View
+from pydantic import BaseModel
+
+from some_aiohttp_middleware import DynamoDB, DynamoDBConfig
+
+
+class Config(BaseModel):
+    dynamodb: dict[str, DynamoDBConfig] = {
+        "1": DynamoDBConfig(region="eu-west-1", table="table_1"),
+        "2": DynamoDBConfig(region="eu-west-1", table="table_2"),
+        "3": DynamoDBConfig(
+            region="eu-west-1", table="table_3", endpoint_url="http://localhost:8000"
+        ),
+    }
+
+
+@pytest.mark.asyncio
+async def test_shared_clients(aiohttp_client):
+    used = []
+
+    @DynamoDB.decorate
+    class TestView(View):
+        async def get(self):
+            tables = self.request["dynamodb"]
+            async with tables[self.request.query["table"]] as client:
+                used.append(client)
+            assert list(tables) == [self.request.query["table"]]
+            assert "2" in tables
+            assert tables.get("4") is None
+            return Response(text="ok")
+
+    app = web.Application()
+    app.config = Config()
+    app.cleanup_ctx.append(DynamoDB.ctx)
+    app.router.add_view("/", TestView)
+
+    async with await aiohttp_client(app) as client:
+        clients = app["dynamodb"]["clients"]
+        assert list(clients) == [
+            ("eu-west-1", None),
+            ("eu-west-1", "http://localhost:8000"),
+        ]
+        for table in ["1", "2", "3", "1"]:
+            resp = await client.get("/", params={"table": table})
+            assert resp.status == 200
+
+    assert used == [
+        clients[("eu-west-1", None)],
+        clients[("eu-west-1", None)],
+        clients[("eu-west-1", "http://localhost:8000")],
+        clients[("eu-west-1", None)],
+    ]
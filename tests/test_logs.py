@@ -0,0 +1,66 @@
+import logging
+
+import pytest
+from aiohttp import web
+from aiohttp.web import Response, View
+
+from some_aiohttp_middleware import CorrelationId
+from some_aiohttp_middleware.logs import CorrelationIdFilter, correlation_id
+
+
+@pytest.mark.asyncio
+async def test_correlation_id(aiohttp_client):
+    records = []
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+
+    handler = Handler()
+    handler.addFilter(CorrelationIdFilter())
+    logger = logging.getLogger("some_aiohttp_middleware.test")
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    class TestView(View):
+        async def get(self):
+            logger.info("Handling %s", self.request.path)
+            return Response(text=self.request["correlation_id"])
+
+    app = web.Application(middlewares=[CorrelationId.middleware()])
+    app.router.add_view("/", TestView)
+
+    try:
+        async with await aiohttp_client(app) as client:
+            resp = await client.get("/", headers={"X-Request-ID": "abc-123"})
+            assert resp.status == 200
+            assert resp.headers["X-Request-ID"] == "abc-123"
+            assert await resp.text() == "abc-123"
+
+            # Invalid ids are replaced by a new one
+            resp = await client.get("/", headers={"X-Request-ID": "a b"})
+            generated = resp.headers["X-Request-ID"]
+            assert len(generated) == 32
+            assert await resp.text() == generated
+
+            resp = await client.get("/")
+            assert resp.headers["X-Request-ID"] not in ("", generated)
+    finally:
+        logger.removeHandler(handler)
+
+    assert [(r.getMessage(), r.correlation_id) for r in records[:2]] == [
+        ("Handling /", "abc-123"),
+        ("Handling /", generated),
+    ]
+    # Outside of a request
+    assert correlation_id.get() == "-"
+
+
+def test_package_loggers():
+    assert any(
+        isinstance(h, logging.NullHandler)
+        for h in logging.getLogger("some_aiohttp_middleware").handlers
+    )
+    # No level is forced on the loggers, it is up to the application
+    for name in ["", "some_aiohttp_middleware", "some_aiohttp_middleware.db"]:
+        assert logging.getLogger(name).level in (logging.NOTSET, logging.WARNING)
@@ -0,0 +1,135 @@
+import pytest
+from aiohttp import web
+from aiohttp.web import Response, View
+from aiomcache.exceptions import ClientException
+from pydantic import BaseModel
+
+from some_aiohttp_middleware.memcached import (  # isort:skip
+    LocalCache,
+    Memcached,
+    MemcachedConfig,
+    TieredCache,
+)
+
+
+class WrongConfig(BaseModel):
+    pass
+
+
+class Config(BaseModel):
+    memcached: MemcachedConfig = MemcachedConfig(pool_size=4, pool_minsize=1)
+
+
+@pytest.mark.asyncio
+async def test_shared_client(aiohttp_client):
+    clients = []
+
+    @Memcached.decorate
+    class TestView(View):
+        async def get(self):
+            clients.append(self.request["memcached"])
+            assert self.request["cache"].client is self.request["memcached"]
+            return Response(text="ok")
+
+    app = web.Application()
+    app.config = Config()
+    app.cleanup_ctx.append(Memcached.ctx)
+    app.router.add_view("/", TestView)
+
+    async with await aiohttp_client(app) as client:
+        for _ in range(3):
+            resp = await client.get("/")
+            assert resp.status == 200
+        assert clients == [app["memcached"]] * 3
+        assert app["memcached"]._pool._maxsize == 4
+        assert app["memcached"]._pool._minsize == 1
+
+
+@pytest.mark.asyncio
+async def test_missing_config(aiohttp_client):
+    app = web.Application()
+    app.config = WrongConfig()
+    app.cleanup_ctx.append(Memcached.ctx)
+
+    with pytest.raises(RuntimeError) as exc_info:
+        await aiohttp_client(app)
+    assert "Memcached definition needed in the configuration" == str(exc_info.value)
+
+
+class FakeClient:
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+
+    async def get(self, key):
+        self.calls.append(("get", key))
+        return self.data.get(key)
+
+    async def multi_get(self, *keys):
+        if len(set(keys)) != len(keys):
+            raise ClientException("duplicate keys passed to multi_get")
+        self.calls.append(("multi_get", *keys))
+        return tuple(self.data.get(key) for key in keys)
+
+    async def set(self, key, value, exptime=0):
+        self.data[key] = value
+        return True
+
+    async def delete(self, key):
+        return self.data.pop(key, None) is not None
+
+
+def test_local_cache():
+    cache = LocalCache(max_entries=2, max_bytes=10)
+    cache.set(b"a", b"1234")
+    cache.set(b"b", b"1234")
+    assert cache.get(b"a") == b"1234"
+    cache.set(b"c", b"1234")
+    assert cache.get(b"b") is None
+    cache.set(b"d", b"12345678")
+    assert list(cache.entries) == [b"d"]
+    assert cache.size == 8
+    cache.set(b"d", b"12345678901")
+    assert cache.get(b"d") is None
+    cache.set(b"f", b"1")
+    cache.entries[b"f"] = (b"1", 0)
+    assert cache.get(b"f") is None
+    assert cache.stats == {"hits": 1, "misses": 3, "evictions": 3}
+
+
+@pytest.mark.asyncio
+async def test_tiered_cache_duplicates():
+    client = FakeClient()
+    cache = TieredCache(client, LocalCache())
+    client.data = {b"a": b"1"}
+
+    assert await cache.multi_get(b"a", b"x", b"a", b"x") == (b"1", None, b"1", None)
+    assert client.calls == [("multi_get", b"a", b"x")]
+
+
+@pytest.mark.asyncio
+async def test_tiered_cache():
+    client = FakeClient()
+    cache = TieredCache(client, LocalCache())
+    client.data = {b"a": b"1", b"b": b"2", b"c": b"3"}
+
+    assert await cache.get(b"a") == b"1"
+    assert await cache.get(b"a") == b"1"
+    assert await cache.get(b"x", b"default") == b"default"
+    assert await cache.multi_get(b"a", b"b", b"c", b"x") == (b"1", b"2", b"3", None)
+    assert await cache.multi_get(b"a", b"b", b"c") == (b"1", b"2", b"3")
+    assert client.calls == [
+        ("get", b"a"),
+        ("get", b"x"),
+        ("multi_get", b"b", b"c", b"x"),
+    ]
+
+    await cache.set(b"a", b"4")
+    assert await cache.get(b"a") == b"4"
+    await cache.delete(b"a")
+    assert await cache.get(b"a") is None
+
+    assert cache.stats == {
+        "local": {"hits": 6, "misses": 6, "evictions": 0},
+        "memcached": {"hits": 3, "misses": 3, "evictions": 0},
+    }
@@ -1,10 +1,18 @@
+import asyncio
+
 import pytest
 from aiohttp import web
 from aiohttp.web import View
-from aiohttp.web_exceptions import HTTPOk
+from aiohttp.web_exceptions import HTTPInternalServerError, HTTPOk
 from aiohttp.web_response import Response
 
-from some_aiohttp_middleware import MiddlewareBase
+from some_aiohttp_middleware.base import Histogram, Instrumentation
+
+from some_aiohttp_middleware import (  # isort:skip
+    MiddlewareBase,
+    MiddlewareChain,
+    RouteDispatcher,
+)
 
 
 class Middleware1(MiddlewareBase):
@@ -70,3 +78,297 @@ async def test_middleware(aiohttp_client):
         assert resp.status == 200
         text = await resp.text()
         assert "Hello, world" in text
+
+
+class Middleware3(MiddlewareBase):
+
+    @staticmethod
+    async def handle(request, *args, **kwargs):
+        request["awm"].update({"no": "unhandle"})
+
+
+@pytest.mark.asyncio
+async def test_chain(aiohttp_client):
+    class TestView(View):
+        async def get(self):
+            assert self.request["awm"] == {
+                "foo": "bar",
+                "hello": "world",
+                "hey": "you",
+                "no": "unhandle",
+            }
+            return Response(text="Hello, world")
+
+    chain = MiddlewareChain(
+        Middleware1(foo="bar", hello="world"), Middleware2(hey="you"), Middleware3
+    )
+    assert [unhandle is None for _, unhandle, _ in chain.stages] == [
+        False,
+        False,
+        True,
+    ]
+
+    app = web.Application(middlewares=[chain.middleware()])
+    app.router.add_view("/tw", TestView)
+    async with await aiohttp_client(app) as client:
+        resp = await client.get("/tw")
+        assert resp.status == 200
+        text = await resp.text()
+        assert "Hello, world" in text
+
+
+@pytest.mark.asyncio
+async def test_chain_unhandle_on_error(aiohttp_client):
+    calls = []
+
+    class Recorder(MiddlewareBase):
+
+        @staticmethod
+        async def handle(request, *args, name=None, fail=False, **kwargs):
+            calls.append(f"handle_{name}")
+            if fail:
+                raise HTTPInternalServerError
+
+        @staticmethod
+        async def unhandle(request, response, *args, name=None, **kwargs):
+            calls.append(f"unhandle_{name}_{response is None}")
+
+    async def handler(request):
+        return Response(text="unreachable")
+
+    app = web.Application(
+        middlewares=[
+            MiddlewareChain(
+                Recorder(name="a"), Recorder(name="b"), Recorder(name="c", fail=True)
+            ).middleware()
+        ]
+    )
+    app.router.add_get("/", handler)
+    async with await aiohttp_client(app) as client:
+        resp = await client.get("/")
+        assert resp.status == 500
+    assert calls == [
+        "handle_a",
+        "handle_b",
+        "handle_c",
+        "unhandle_b_True",
+        "unhandle_a_True",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_chain_unhandle_fails(aiohttp_client):
+    calls = []
+
+    class Recorder(MiddlewareBase):
+
+        @staticmethod
+        async def handle(request, *args, name=None, **kwargs):
+            calls.append(f"handle_{name}")
+
+        @staticmethod
+        async def unhandle(request, response, *args, name=None, fail=False, **kwargs):
+            calls.append(f"unhandle_{name}_{response is None}")
+            if fail:
+                raise HTTPInternalServerError
+
+    async def handler(request):
+        return Response(text="ok")
+
+    # The same as stacking Recorder(name="a") and Recorder(name="b", fail=True)
+    app = web.Application(
+        middlewares=[
+            MiddlewareChain(
+                Recorder(name="a"), Recorder(name="b", fail=True)
+            ).middleware()
+        ]
+    )
+    app.router.add_get("/", handler)
+    async with await aiohttp_client(app) as client:
+        resp = await client.get("/")
+        assert resp.status == 500
+    assert calls == ["handle_a", "handle_b", "unhandle_b_False", "unhandle_a_True"]
+
+
+class Backend(MiddlewareBase):
+
+    @staticmethod
+    async def handle(request, *args, name=None, fail=False, **kwargs):
+        # Every backend waits for all others, so handles run one after another
+        # would never finish
+        assert request["auth"] == "ok"
+        request["started"].add(name)
+        while request["started"] != {"a", "b", "c"}:
+            await asyncio.sleep(0)
+        request["calls"].append(f"handle_{name}")
+        if fail:
+            raise HTTPInternalServerError
+
+    @staticmethod
+    async def unhandle(request, response, *args, name=None, **kwargs):
+        request["calls"].append(f"unhandle_{name}_{response is None}")
+
+
+class Auth(MiddlewareBase):
+
+    @staticmethod
+    async def handle(request, *args, **kwargs):
+        request["auth"] = "ok"
+        request["started"] = set()
+        request["calls"] = calls = []
+        request.app["calls"].append(calls)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fail", [None, "b"])
+async def test_chain_concurrent_group(aiohttp_client, fail):
+    async def handler(request):
+        request["calls"].append("handler")
+        return Response(text="ok")
+
+    chain = MiddlewareChain(
+        Auth,
+        [Backend(name=name, fail=name == fail) for name in ["a", "b", "c"]],
+    )
+    assert len(chain.groups) == 2
+    assert len(chain.stages) == 4
+
+    app = web.Application(middlewares=[chain.middleware()])
+    app["calls"] = []
+    app.router.add_get("/", handler)
+    async with await aiohttp_client(app) as client:
+        resp = await asyncio.wait_for(client.get("/"), 5)
+        assert resp.status == (500 if fail else 200)
+
+    [calls] = app["calls"]
+    assert sorted(calls[:3]) == ["handle_a", "handle_b", "handle_c"]
+    if fail:
+        assert calls[3:] == ["unhandle_c_True", "unhandle_a_True"]
+    else:
+        assert calls[3:] == [
+            "handler",
+            "unhandle_c_False",
+            "unhandle_b_False",
+            "unhandle_a_False",
+        ]
+
+
+@pytest.mark.asyncio
+async def test_instrumentation(aiohttp_client):
+    instrumentation = Instrumentation(server_timing=True)
+
+    middleware1 = Middleware1(foo="bar", hello="world")
+    middleware1.instrumentation = instrumentation
+    middleware2 = Middleware2(hey="you")
+    middleware2.instrumentation = instrumentation
+
+    class TestView(View):
+        async def get(self):
+            return Response(text="Hello, world")
+
+    app = web.Application(
+        middlewares=[
+            middleware1.middleware(),
+            MiddlewareChain(middleware2, Middleware3).middleware(),
+        ]
+    )
+    app.router.add_view("/tw/{id}", TestView)
+    async with await aiohttp_client(app) as client:
+        for i in range(3):
+            resp = await client.get(f"/tw/{i}")
+            assert resp.status == 200
+            assert [
+                t.split(";")[0]
+                for t in ", ".join(resp.headers.getall("Server-Timing")).split(", ")
+            ] == [
+                "Middleware2-handle",
+                "Middleware2-handler",
+                "Middleware2-unhandle",
+                "Middleware1-handle",
+                "Middleware1-handler",
+                "Middleware1-unhandle",
+            ]
+
+    assert sorted(instrumentation.histograms) == [
+        (name, "/tw/{id}", phase)
+        for name in ["Middleware1", "Middleware2"]
+        for phase in ["handle", "handler", "unhandle"]
+    ]
+    for histogram in instrumentation.histograms.values():
+        assert histogram.count == 3
+        assert sum(histogram.counts) == 3
+        assert 0 < histogram.percentile(50) <= histogram.max
+
+
+def test_histogram():
+    histogram = Histogram()
+    for us in range(1, 1001):
+        histogram.record(us * 1000)
+    assert histogram.count == 1000
+    assert histogram.max == 1_000_000
+    assert 500_000 <= histogram.percentile(50) <= 1.25 * 500_000
+    assert histogram.percentile(99) == 1_000_000
+    histogram.record(10**12)
+    assert histogram.counts[-1] == 1
+
+
+@pytest.mark.asyncio
+async def test_route_dispatcher(aiohttp_client):
+    class Tag(MiddlewareBase):
+
+        @staticmethod
+        async def handle(request, *args, tag=None, **kwargs):
+            request.setdefault("tags", []).append(tag)
+
+    async def handler(request):
+        return Response(text=",".join(request.get("tags", [])))
+
+    class TestView(View):
+        async def get(self):
+            return await handler(self.request)
+
+        async def post(self):
+            return await handler(self.request)
+
+    dispatcher = RouteDispatcher()
+    dispatcher.add(Tag(tag="all"))
+    dispatcher.add(Tag(tag="api"), prefix="/api/")
+    dispatcher.add(Tag(tag="post"), methods=["post"])
+    dispatcher.add(Tag(tag="named"), names={"named"})
+
+    app = web.Application()
+    app.router.add_get("/health", handler)
+    app.router.add_get("/api", handler)
+    app.router.add_get("/api/{id}", handler, name="named")
+    app.router.add_get("/apix", handler)
+    app.router.add_view("/api/view", TestView)
+    sub = web.Application()
+    sub.router.add_get("/x", handler)
+    app.add_subapp("/sub", sub)
+    dispatcher.setup(app)
+
+    async with await aiohttp_client(app) as client:
+        for method, path, tags in [
+            ("GET", "/health", "all"),
+            ("GET", "/api", "all,api"),
+            ("GET", "/api/1", "all,api,named"),
+            ("GET", "/apix", "all"),
+            ("GET", "/api/view", "all,api"),
+            ("POST", "/api/view", "all,api,post"),
+            ("GET", "/sub/x", "all"),
+        ]:
+            resp = await client.request(method, path)
+            assert resp.status == 200
+            assert await resp.text() == tags
+        assert (await client.get("/missing")).status == 404
+
+
+@pytest.mark.asyncio
+async def test_route_dispatcher_not_set_up(aiohttp_client):
+    async def handler(request):
+        return Response(text="ok")
+
+    app = web.Application(middlewares=[RouteDispatcher().middleware()])
+    app.router.add_get("/", handler)
+    async with await aiohttp_client(app) as client:
+        assert (await client.get("/")).status == 500
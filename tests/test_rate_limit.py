@@ -0,0 +1,192 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.web import Response, View
+from aiomcache.exceptions import ClientException
+
+from some_aiohttp_middleware import DB, AdminAuth
+
+from some_aiohttp_middleware.rate_limit import (  # isort:skip
+    RateLimit,
+    SharedWindows,
+    TokenBuckets,
+)
+
+
+def test_token_buckets():
+    buckets = TokenBuckets(rate=2, burst=3, sweep_interval=10)
+    start = buckets.next_sweep - 10
+    assert [buckets.take("a", start) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("a", start) == pytest.approx(0.5)
+    assert buckets.take("b", start) == 0
+
+    # One token after half a second
+    assert buckets.take("a", start + 0.5) == 0
+    assert buckets.take("a", start + 0.5) == pytest.approx(0.5)
+
+    # Full buckets are swept
+    buckets.take("b", start + 9)
+    assert set(buckets.buckets) == {"a", "b"}
+    buckets.take("c", start + 10)
+    assert set(buckets.buckets) == {"b", "c"}
+
+
+class FakeMemcached:
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+
+    async def incr(self, key, increment=1):
+        self.calls.append("incr")
+        if key not in self.data:
+            # Like aiomcache.Client.incr
+            raise ClientException("Memcached b'incr' command failed", b"NOT_FOUND")
+        self.data[key] += increment
+        return self.data[key]
+
+    async def add(self, key, value, exptime=0):
+        self.calls.append("add")
+        if key in self.data:
+            return False
+        self.data[key] = int(value)
+        return True
+
+
+@pytest.mark.asyncio
+async def test_shared_windows():
+    client = FakeMemcached()
+    process1 = SharedWindows(limit=10, window=10, batch=4)
+    process2 = SharedWindows(limit=10, window=10, batch=4)
+
+    assert [await process1.hit(client, "a", 100) for _ in range(4)] == [0] * 4
+    assert client.calls == ["incr", "add"]
+    assert [await process2.hit(client, "a", 101) for _ in range(4)] == [0] * 4
+    assert list(client.data.values()) == [8]
+
+    # process2 knows the 8 requests of both processes
+    assert [await process2.hit(client, "a", 102) for _ in range(3)] == [0, 0, 8]
+    # process1 only knows its own 4 until it increments the next time
+    assert [await process1.hit(client, "a", 103) for _ in range(4)] == [0] * 4
+    assert await process1.hit(client, "a", 104) == 6
+    assert list(client.data.values()) == [12]
+
+    # The next window starts from scratch
+    assert await process1.hit(client, "a", 110) == 0
+    assert list(process1.windows) == ["a"]
+
+
+class SlowMemcached(FakeMemcached):
+    async def incr(self, key, increment=1):
+        await asyncio.sleep(0.01)
+        return await super().incr(key, increment)
+
+    async def add(self, key, value, exptime=0):
+        await asyncio.sleep(0.01)
+        return await super().add(key, value, exptime)
+
+
+@pytest.mark.asyncio
+async def test_shared_windows_concurrent():
+    client = SlowMemcached()
+    windows = SharedWindows(limit=100, window=10, batch=10)
+
+    results = await asyncio.gather(*(windows.hit(client, "a", 100) for _ in range(30)))
+    assert results == [0] * 30
+    # One flush at a time, the hits meanwhile stay pending
+    assert client.calls == ["incr", "add"]
+    assert list(client.data.values()) == [10]
+    assert windows.windows["a"][1:] == [10, 20, False]
+
+    await windows.hit(client, "a", 101)
+    assert list(client.data.values()) == [31]
+    assert windows.windows["a"][1:] == [31, 0, False]
+
+
+@pytest.mark.asyncio
+async def test_middleware(aiohttp_client):
+    opened = []
+
+    class FakeSession:
+        async def __aenter__(self):
+            opened.append(self)
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+    class TestView(View):
+        async def get(self):
+            return Response(text="ok")
+
+    rate_limit = RateLimit(rate=0.1, burst=2, key=lambda r: r.headers["X-Client"])
+    app = web.Application(middlewares=[rate_limit.middleware(), DB.middleware()])
+    app["db_session_maker"] = {"default": FakeSession}
+    app.router.add_view("/", TestView)
+
+    async with await aiohttp_client(app) as client:
+        for status in [200, 200, 429]:
+            resp = await client.get("/", headers={"X-Client": "1"})
+            assert resp.status == status
+        assert resp.headers["Retry-After"] == "10"
+        resp = await client.get("/", headers={"X-Client": "2"})
+        assert resp.status == 200
+
+    # The rejected request did not open a session
+    assert len(opened) == 3
+
+
+@pytest.mark.asyncio
+async def test_distributed(aiohttp_client):
+    class TestView(View):
+        async def get(self):
+            return Response(text="ok")
+
+    app = web.Application(
+        middlewares=[
+            RateLimit(
+                rate=100, burst=100, distributed=True, limit=3, window=60, batch=1
+            ).middleware()
+        ]
+    )
+    app["memcached"] = FakeMemcached()
+    app.router.add_view("/", TestView)
+
+    async with await aiohttp_client(app) as client:
+        assert [(await client.get("/")).status for _ in range(4)] == [
+            200,
+            200,
+            200,
+            429,
+        ]
+    assert list(app["memcached"].data.values()) == [3]
+
+
+@pytest.mark.asyncio
+async def test_token_key(aiohttp_client):
+    token = "cb466ec795d74a8eb4a1c49e2feb2acd"
+    rate_limit = RateLimit(rate=0.1, burst=1, key="token")
+
+    async def handler(request):
+        return Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/", rate_limit.decorate(handler))
+    app.router.add_get(
+        "/admin", AdminAuth(admin_token=token).decorate(rate_limit.decorate(handler))
+    )
+
+    async with await aiohttp_client(app) as client:
+        # Unverified tokens do not get buckets of their own
+        for status, fake in [(200, "a"), (429, "b")]:
+            resp = await client.get("/", headers={"Authorization": f"Bearer {fake}"})
+            assert resp.status == status
+
+        resp = await client.get("/admin", headers={"Authorization": f"Bearer {token}"})
+        assert resp.status == 200
+    assert len(rate_limit.kwargs["limiter"].buckets) == 2
+
+
+def test_unconfigured():
+    with pytest.raises(ValueError):
+        RateLimit(rate=0)
@@ -0,0 +1,200 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.web import Response
+
+from some_aiohttp_middleware.memcached import Memcached
+from some_aiohttp_middleware.response_cache import ResponseCache
+
+
+class FakeMemcached:
+    def __init__(self):
+        self.data = {}
+        self.sets = []
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, exptime=0):
+        self.sets.append((key, exptime))
+        self.data[key] = value
+
+    async def close(self):
+        pass
+
+
+async def fake_ctx(app):
+    app["memcached"] = FakeMemcached()
+    yield
+
+
+def create_app(handler, **kwargs):
+    app = web.Application(
+        middlewares=[Memcached.middleware(), ResponseCache(**kwargs).middleware()]
+    )
+    app.cleanup_ctx.append(fake_ctx)
+    app.cleanup_ctx.append(ResponseCache.ctx)
+    app.router.add_get("/", handler)
+    app.router.add_post("/", handler)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_cache(aiohttp_client):
+    calls = []
+
+    async def handler(request):
+        calls.append(request.method)
+        return Response(text=f"hello {len(calls)}")
+
+    app = create_app(handler, ttl=30)
+    async with await aiohttp_client(app) as client:
+        resp = await client.get("/")
+        assert await resp.text() == "hello 1"
+        etag = resp.headers["ETag"]
+
+        resp = await client.get("/")
+        assert resp.status == 200
+        assert await resp.text() == "hello 1"
+        assert resp.headers["ETag"] == etag
+        assert resp.headers["Content-Type"] == "text/plain; charset=utf-8"
+
+        resp = await client.get("/", headers={"If-None-Match": etag})
+        assert resp.status == 304
+
+        resp = await client.get("/?page=2")
+        assert await resp.text() == "hello 2"
+
+        resp = await client.get("/", headers={"Cache-Control": "no-cache"})
+        assert await resp.text() == "hello 3"
+
+        resp = await client.post("/")
+        assert await resp.text() == "hello 4"
+
+        assert [ttl for _, ttl in app["memcached"].sets] == [30, 30, 30]
+        assert calls == ["GET", "GET", "GET", "POST"]
+
+
+@pytest.mark.asyncio
+async def test_cache_control(aiohttp_client):
+    calls = []
+
+    async def handler(request):
+        calls.append(request.method)
+        return Response(
+            text="hello", headers={"Cache-Control": request.query["cache_control"]}
+        )
+
+    app = create_app(handler)
+    async with await aiohttp_client(app) as client:
+        for _ in range(2):
+            await client.get("/?cache_control=no-store")
+            await client.get("/?cache_control=private")
+            await client.get("/?cache_control=max-age=5")
+        assert len(calls) == 5
+        assert [ttl for _, ttl in app["memcached"].sets] == [5]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("headers", [(), ("Authorization",)])
+async def test_authorization(aiohttp_client, headers):
+    calls = []
+
+    async def handler(request):
+        calls.append(request.method)
+        user = request.headers.get("Authorization", "anonymous")
+        return Response(
+            text=f"hello {user}",
+            headers={"Vary": "Authorization", **request.query},
+        )
+
+    app = create_app(handler, headers=headers)
+    async with await aiohttp_client(app) as client:
+        for _ in range(2):
+            for user in ["Bearer alice", "Bearer bob"]:
+                resp = await client.get("/", headers={"Authorization": user})
+                assert await resp.text() == f"hello {user}"
+            resp = await client.get("/")
+            assert await resp.text() == "hello anonymous"
+
+        # Public responses are stored, but only if Authorization is part of the key
+        for _ in range(2):
+            for user in ["Bearer alice", "Bearer bob"]:
+                resp = await client.get(
+                    "/?Cache-Control=public", headers={"Authorization": user}
+                )
+                assert await resp.text() == f"hello {user}"
+
+    stored = len(app["memcached"].sets)
+    if headers:
+        assert (len(calls), stored) == (5 + 2, 1 + 2)
+    else:
+        assert (len(calls), stored) == (6 + 4, 0)
+
+
+@pytest.mark.asyncio
+async def test_coalescing(aiohttp_client):
+    calls = []
+
+    async def handler(request):
+        calls.append(request.method)
+        await asyncio.sleep(0.1)
+        return Response(text="hello")
+
+    app = create_app(handler)
+    async with await aiohttp_client(app) as client:
+        responses = await asyncio.gather(*[client.get("/") for _ in range(10)])
+        assert [r.status for r in responses] == [200] * 10
+        assert [await r.text() for r in responses] == ["hello"] * 10
+        assert len(calls) == 1
+        assert app["response_cache"] == {}
+
+
+@pytest.mark.asyncio
+async def test_coalescing_failure(aiohttp_client):
+    calls = []
+
+    async def handler(request):
+        calls.append(request.method)
+        await asyncio.sleep(0.1)
+        if len(calls) == 1:
+            raise web.HTTPServiceUnavailable
+        return Response(text="hello")
+
+    app = create_app(handler)
+    async with await aiohttp_client(app) as client:
+        responses = await asyncio.gather(*[client.get("/") for _ in range(3)])
+        assert sorted(r.status for r in responses) == [200, 200, 503]
+        assert len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_coalescing_cancelled(aiohttp_client):
+    calls = []
+
+    async def handler(request):
+        calls.append(request.method)
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return Response(text="hello")
+
+    @web.middleware
+    async def deadline(request, handler):
+        try:
+            return await asyncio.wait_for(handler(request), 0.1)
+        except asyncio.TimeoutError:
+            raise web.HTTPGatewayTimeout
+
+    app = create_app(handler, timeout=3)
+    app.middlewares.insert(0, deadline)
+    async with await aiohttp_client(app) as client:
+        resp = await client.get("/")
+        assert resp.status == 504
+        assert app["response_cache"] == {}
+
+        # The next request does not wait for the cancelled one
+        start = asyncio.get_running_loop().time()
+        resp = await client.get("/")
+        assert await resp.text() == "hello"
+        assert asyncio.get_running_loop().time() - start < 1
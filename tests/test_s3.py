@@ -55,6 +55,7 @@ async def test_middleware(caplog, aiohttp_client):
         ]
     )
     app.config = Config()
+    app.cleanup_ctx.append(S3.ctx)
     app.router.add_view("/tw1", TestView1)
     app.router.add_view("/tw2", TestView2)
     client = await aiohttp_client(app)
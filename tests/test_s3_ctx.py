@@ -0,0 +1,52 @@
+import pytest
+from aiohttp import web
+from aiohttp.web import Response, View
+from pydantic import BaseModel
+
+from some_aiohttp_middleware import S3, S3Config
+
+
+class Config(BaseModel):
+    s3: list[S3Config] = [
+        S3Config("1", region="eu-west-1", bucket="bucket_1"),
+        S3Config("2", region="eu-west-1", bucket="bucket_2"),
+        S3Config("3", region="eu-central-1", bucket="bucket_3"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_ctx(aiohttp_client):
+    @S3.decorate
+    class TestView(View):
+        async def get(self):
+            assert self.request["s3"] is self.request.app["s3"]["buckets"]
+            return Response(text=self.request["s3"][self.request.query["name"]].name)
+
+    app = web.Application()
+    app.config = Config()
+    app.cleanup_ctx.append(S3.ctx)
+    app.router.add_view("/", TestView)
+
+    async with await aiohttp_client(app) as client:
+        assert list(app["s3"]["sessions"]) == ["eu-west-1", "eu-central-1"]
+        for _ in range(2):
+            for name in ["1", "2", "3"]:
+                resp = await client.get("/", params={"name": name})
+                assert resp.status == 200
+                assert await resp.text() == f"bucket_{name}"
+
+
+@pytest.mark.asyncio
+async def test_missing_ctx(aiohttp_client):
+    @S3.decorate
+    class TestView(View):
+        async def get(self):
+            return Response(text="unreachable")
+
+    app = web.Application()
+    app.config = Config()
+    app.router.add_view("/", TestView)
+
+    async with await aiohttp_client(app) as client:
+        resp = await client.get("/")
+        assert resp.status == 500
@@ -0,0 +1,158 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+from botocore.exceptions import ClientError
+
+from some_aiohttp_middleware import s3
+from some_aiohttp_middleware.s3 import stream_object, upload_stream
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+        self.reads = []
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.closed = True
+
+    async def read(self, amt=None):
+        chunk, self.data = self.data[:amt], self.data[amt:]
+        self.reads.append(len(chunk))
+        return chunk
+
+
+class FakeClient:
+    def __init__(self, objects):
+        self.objects = objects
+        self.bodies = []
+        self.parts = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = []
+
+    async def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        data = self.objects[Key]
+        result = {"ContentType": "text/plain", "ETag": '"etag"'}
+        if Range:
+            start, end = Range.removeprefix("bytes=").split("-")
+            start = int(start)
+            if start >= len(data):
+                raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+            end = min(int(end), len(data) - 1) if end else len(data) - 1
+            result["ContentRange"] = f"bytes {start}-{end}/{len(data)}"
+            data = data[start:][: end + 1 - start]
+        self.bodies.append(FakeBody(data))
+        return result | {"Body": self.bodies[-1], "ContentLength": len(data)}
+
+    async def put_object(self, Bucket, Key, Body, **params):
+        self.calls.append("put_object")
+        self.objects[Key] = Body
+        return {}
+
+    async def create_multipart_upload(self, Bucket, Key, **params):
+        self.calls.append("create_multipart_upload")
+        return {"UploadId": "upload"}
+
+    async def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if Body == b"fail":
+            raise ClientError({"Error": {"Code": "InternalError"}}, "UploadPart")
+        self.parts[PartNumber] = Body
+        return {"ETag": f'"{PartNumber}"'}
+
+    async def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append("complete_multipart_upload")
+        parts = MultipartUpload["Parts"]
+        assert [p["PartNumber"] for p in parts] == list(range(1, len(parts) + 1))
+        self.objects[Key] = b"".join(self.parts[p["PartNumber"]] for p in parts)
+        return {}
+
+    async def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append("abort_multipart_upload")
+
+
+def create_app(client, **kwargs):
+    bucket = SimpleNamespace(name="bucket", meta=SimpleNamespace(client=client))
+
+    async def download(request):
+        return await stream_object(request, bucket, request.match_info["key"], 4)
+
+    async def upload(request):
+        await upload_stream(request, bucket, request.match_info["key"], **kwargs)
+        return web.Response(status=201)
+
+    app = web.Application()
+    app.router.add_get("/{key}", download)
+    app.router.add_put("/{key}", upload)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_stream_object(aiohttp_client):
+    client = FakeClient({"key": b"0123456789"})
+    async with await aiohttp_client(create_app(client)) as http:
+        resp = await http.get("/key")
+        assert resp.status == 200
+        assert await resp.read() == b"0123456789"
+        assert resp.headers["Content-Length"] == "10"
+        assert resp.headers["ETag"] == '"etag"'
+        assert client.bodies[-1].reads == [4, 4, 2, 0]
+        assert client.bodies[-1].closed
+
+        resp = await http.get("/key", headers={"Range": "bytes=2-5"})
+        assert resp.status == 206
+        assert await resp.read() == b"2345"
+        assert resp.headers["Content-Range"] == "bytes 2-5/10"
+
+        resp = await http.get("/key", headers={"Range": "bytes=20-"})
+        assert resp.status == 416
+        resp = await http.get("/key", headers={"Range": "bytes=a-b"})
+        assert resp.status == 416
+        resp = await http.get("/missing")
+        assert resp.status == 404
+
+
+@pytest.mark.asyncio
+async def test_upload_stream(aiohttp_client, monkeypatch):
+    monkeypatch.setattr(s3, "MIN_PART_SIZE", 4)
+    client = FakeClient({})
+    async with await aiohttp_client(
+        create_app(client, part_size=4, concurrency=2)
+    ) as http:
+        resp = await http.put("/small", data=b"012")
+        assert resp.status == 201
+        assert client.objects["small"] == b"012"
+        assert client.calls == ["put_object"]
+
+        data = b"0123456789" * 5
+        resp = await http.put("/large", data=data)
+        assert resp.status == 201
+        assert client.objects["large"] == data
+        assert len(client.parts) == 13
+        assert client.max_in_flight == 2
+        assert client.calls[1:] == [
+            "create_multipart_upload",
+            "complete_multipart_upload",
+        ]
+
+        client.calls.clear()
+        resp = await http.put("/failed", data=b"0123failfail0123")
+        assert resp.status == 500
+        assert "failed" not in client.objects
+        assert client.calls == ["create_multipart_upload", "abort_multipart_upload"]
+
+
+def test_part_size():
+    with pytest.raises(ValueError):
+        asyncio.run(upload_stream(None, None, "key", part_size=1024))
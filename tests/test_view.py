@@ -4,6 +4,7 @@ import pytest
 from aiohttp.test_utils import make_mocked_request
 from aiohttp.web import View
 from aiohttp.web_exceptions import HTTPOk
+from aiohttp_pydantic import PydanticView
 
 from some_aiohttp_middleware import MiddlewareBase
 
@@ -217,3 +218,97 @@ async def test_class_method_kwargs(capfd):
     out, err = capfd.readouterr()
 
     assert out == "bar_handle_get_bar_unhandlebar_handle_post_bar_unhandlea_"
+
+
+def test_class_cached():
+    class Test(View):
+        async def get(self):
+            return HTTPOk()
+
+    assert Middleware.decorate(Test) is Middleware.decorate(Test)
+    assert Middleware.decorate(foo="bar")(Test) is Middleware.decorate(foo="bar")(Test)
+    assert Middleware.decorate(Test) is not Middleware.decorate(foo="bar")(Test)
+    assert Middleware.decorate(Test) is not Middleware().decorate(Test)
+    assert "__getattribute__" not in vars(Middleware.decorate(Test))
+
+
+@pytest.mark.asyncio
+async def test_class_stacked(capfd):
+    @Middleware.decorate(foo="bar")
+    @Middleware.decorate(hello="world")
+    class Test(View):
+        async def get(self):
+            print(inspect.currentframe().f_code.co_name, end="_")
+            return HTTPOk()
+
+    await Test(make_mocked_request("GET", "/", headers={"token": "x42"})).get()
+
+    out, err = capfd.readouterr()
+
+    assert out == "bar_handle_world_handle_get_world_unhandlebar_unhandle"
+
+
+@pytest.mark.asyncio
+async def test_pydantic_view(capfd):
+    @Middleware.decorate(foo="bar")
+    class Test(PydanticView):
+        async def get(self, name: str = "nobody"):
+            print(name, end="_")
+            return HTTPOk()
+
+    await Test(make_mocked_request("GET", "/?name=somebody"))
+
+    out, err = capfd.readouterr()
+
+    assert out == "bar_handle_somebody_bar_unhandle"
+
+
+@pytest.mark.asyncio
+async def test_function(capfd):
+    @Middleware.decorate(foo="bar")
+    @Middleware.decorate(hello="world")
+    async def handler(request):
+        print(inspect.currentframe().f_code.co_name, end="_")
+        return HTTPOk()
+
+    assert handler.__name__ == "handler"
+    response = await handler(make_mocked_request("GET", "/"))
+    assert isinstance(response, HTTPOk)
+
+    out, err = capfd.readouterr()
+
+    assert out == "bar_handle_world_handle_handler_world_unhandlebar_unhandle"
+
+
+@pytest.mark.asyncio
+async def test_function_error(capfd):
+    @Middleware().decorate(foo="bar")
+    async def handler(request):
+        raise HTTPOk()
+
+    with pytest.raises(HTTPOk):
+        await handler(make_mocked_request("GET", "/"))
+
+    out, err = capfd.readouterr()
+
+    assert out == "bar_handle_bar_unhandle"
+
+
+@pytest.mark.asyncio
+async def test_function_handle_only(capfd):
+    class HandleOnly(MiddlewareBase):
+        @staticmethod
+        async def handle(request, **kwargs):
+            print("handle", end="_")
+
+    async def handler(request):
+        return HTTPOk()
+
+    wrapped = HandleOnly.decorate(handler)
+    assert wrapped.__wrapped__ is handler
+    assert wrapped.__code__.co_name == "handle_only"
+    await wrapped(make_mocked_request("GET", "/"))
+
+    out, err = capfd.readouterr()
+
+    assert out == "handle_"